@@ -5,6 +5,7 @@ import os
 import litellm
 import json
 import redis
+import xxhash
 from sqlalchemy import create_engine, text, inspect
 from sqlalchemy.orm import sessionmaker
 import logging
@@ -19,13 +20,24 @@ from app.config import get_config, REDIS, LLM, CACHE, DATABASE
 logger = logging.getLogger(__name__)
 
 
+# Handlers by base type for json_serialize; datetime precedes its base class date
+_SERIALIZER_BASES = (
+    (datetime, datetime.isoformat),
+    (date, date.isoformat),
+    (Decimal, str),
+)
+# Exact-type dispatch; subclasses (e.g. pandas Timestamp) are added on first sight
+_SERIALIZERS = dict(_SERIALIZER_BASES)
+
 def json_serialize(obj):
     """JSON serializer for objects not serializable by default json code"""
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    if isinstance(obj, Decimal):
-        return str(obj)
-    raise TypeError(f"Type {type(obj)} not serializable")
+    handler = _SERIALIZERS.get(type(obj))
+    if handler is None:
+        handler = next((fn for cls, fn in _SERIALIZER_BASES if isinstance(obj, cls)), None)
+        if handler is None:
+            raise TypeError(f"Type {type(obj)} not serializable")
+        _SERIALIZERS[type(obj)] = handler
+    return handler(obj)
 
 
 class DatabaseConnectionError(Exception):
@@ -166,9 +178,8 @@ class SQLAgent:
             # Normalize query by removing whitespace and converting to lowercase
             normalized_query = " ".join(query.lower().split())
 
-            # Use a simple hash function less prone to variation
-            import hashlib
-            query_hash = hashlib.md5(normalized_query.encode()).hexdigest()
+            # Stable across processes, unlike builtin hash()
+            query_hash = xxhash.xxh3_64_hexdigest(normalized_query)
 
             # Try to get result with session-specific key
             if session_id:
@@ -210,9 +221,8 @@ class SQLAgent:
             # Normalize query by removing whitespace and converting to lowercase
             normalized_query = " ".join(query.lower().split())
 
-            # Use a simple hash function less prone to variation
-            import hashlib
-            query_hash = hashlib.md5(normalized_query.encode()).hexdigest()
+            # Stable across processes, unlike builtin hash()
+            query_hash = xxhash.xxh3_64_hexdigest(normalized_query)
 
             # Serialize result to JSON string, with special handling for complex types
             result_json = json.dumps(result, default=json_serialize)
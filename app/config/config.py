@@ -27,6 +27,7 @@ REDIS = {
     "host": os.getenv("REDIS_HOST", "redis"),
     "port": int(os.getenv("REDIS_PORT", "6379")),
     "use_cluster": os.getenv("USE_REDIS_CLUSTER", "false").lower() == "true",
+    "max_connections": int(os.getenv("REDIS_MAX_CONNECTIONS", "50")),
 }
 
 # Celery settings
@@ -52,6 +53,23 @@ LLM = {
     "rate_limit": int(os.getenv("LLM_RATE_LIMIT", "60")),
     "failure_threshold": int(os.getenv("LLM_FAILURE_THRESHOLD", "5")),
     "reset_timeout": int(os.getenv("LLM_RESET_TIMEOUT", "30")),
+    # Cheapest first; the last model is the fallback (defaults to just the main model)
+    "suggestion_models": [
+        m.strip() for m in os.getenv("SUGGESTION_MODELS", os.getenv("LITELLM_MODEL", "gpt-4.1-mini")).split(",")
+        if m.strip()
+    ],
+    "suggestion_cascade_timeout": int(os.getenv("SUGGESTION_CASCADE_TIMEOUT", "5")),
+    # Upper bound on concurrent visualization completions per process
+    "max_concurrency": int(os.getenv("LLM_MAX_CONCURRENCY", "16")),
+    # Visualization recommendations are a small JSON object
+    "visualization_max_tokens": int(os.getenv("VISUALIZATION_MAX_TOKENS", "512")),
+    "visualization_batch_concurrency": int(os.getenv("VISUALIZATION_BATCH_CONCURRENCY", "8")),
+    # Most results one batch request may ask about (each can cost a completion)
+    "visualization_batch_max_items": int(os.getenv("VISUALIZATION_BATCH_MAX_ITEMS", "20")),
+    # One tiny completion at startup so the first user request skips cold-start costs.
+    # Off by default: it is billed and delays startup, which adds up when the
+    # server runs with --reload (as the Dockerfile does)
+    "warmup_on_startup": os.getenv("LLM_WARMUP_ON_STARTUP", "false").lower() == "true",
 }
 
 # Cache settings
@@ -60,12 +78,26 @@ CACHE = {
     "llm_cache_ttl": int(os.getenv("LLM_CACHE_TTL", "300")),
     "query_cache_ttl": int(os.getenv("QUERY_CACHE_TTL", "300")),
     "schema_cache_ttl": int(os.getenv("SCHEMA_CACHE_TTL", "3600")),
+    # Embedding-based suggestion cache; needs the RediSearch module (redis-stack)
+    "semantic_cache_enabled": os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true",
+    "semantic_cache_threshold": float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92")),
+    "embedding_model": os.getenv("EMBEDDING_MODEL", "text-embedding-3-small"),
+    "embedding_dim": int(os.getenv("EMBEDDING_DIM", "1536")),
+    # Suggestions warmed ahead of time for similar past exchanges
+    "prefetch_ttl": int(os.getenv("PREFETCH_TTL", "120")),
+    "prefetch_concurrency": int(os.getenv("PREFETCH_CONCURRENCY", "4")),
+    # In-process visualization recommendation cache
+    "viz_cache_size": int(os.getenv("VIZ_CACHE_SIZE", "512")),
+    "viz_cache_ttl": int(os.getenv("VIZ_CACHE_TTL", "600")),
 }
 
 # API settings
 API = {
     "rate_limit_per_minute": int(os.getenv("API_RATE_LIMIT", "30")),
     "cors_origins": os.getenv("CORS_ORIGINS", "*").split(","),
+    "health_cache_ttl": int(os.getenv("HEALTH_CACHE_TTL", "5")),  # seconds
+    # Only honour X-Forwarded-For when the app sits behind a proxy we control
+    "trusted_proxy": os.getenv("TRUSTED_PROXY", "false").lower() == "true",
 }
 
 # Memory Service settings
@@ -74,6 +106,8 @@ MEMORY = {
     "history_limit": int(os.getenv("HISTORY_LIMIT", "10")),
     "retry_delay": int(os.getenv("REDIS_RETRY_DELAY", "1")),
     "max_retries": int(os.getenv("REDIS_MAX_RETRIES", "3")),
+    "history_cache_size": int(os.getenv("HISTORY_CACHE_SIZE", "1024")),
+    "history_cache_ttl": int(os.getenv("HISTORY_CACHE_TTL", "2")),  # seconds
 }
 
 # Logging settings
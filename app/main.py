@@ -15,6 +15,8 @@ import re
 from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
 import psutil
 import redis
+from cachetools.func import ttl_cache
+import pybreaker
 
 from app.services.memory_service import MemoryService
 from app.services.suggestion_service import SuggestionService
@@ -25,7 +27,7 @@ from app.graphs.correction_graph import create_correction_graph
 from app.tasks import process_query_task
 
 # Import config
-from app.config import API, LOGGING, REDIS, MEMORY, CACHE
+from app.config import API, LOGGING, REDIS, MEMORY, CACHE, LLM
 
 from datetime import datetime, timedelta
 from pathlib import Path
@@ -40,6 +42,9 @@ MS_REDIRECT_URI = os.getenv("MS_REDIRECT_URI", "http://localhost:8003/auth/callb
 AUTHORITY = f"https://login.microsoftonline.com/{MS_TENANT_ID}"
 SCOPE = ["user.read"]
 
+# Compiled once; applied to every incoming query
+_DDL_RE = re.compile(r'(DROP|DELETE|TRUNCATE|ALTER)\s+TABLE', re.IGNORECASE)
+
 # Configure logging
 logging.basicConfig(
     level=getattr(logging, LOGGING["level"]),
@@ -60,8 +65,7 @@ query_counter = Counter('sql_queries_total', 'Total SQL queries executed')
 query_latency = Histogram('sql_query_duration_seconds', 'SQL query duration')
 active_sessions = Gauge('active_sessions', 'Number of active sessions')
 error_counter = Counter('application_errors_total', 'Total application errors', ['error_type'])
-cache_hits = Counter('cache_hits_total', 'Total cache hits')
-cache_misses = Counter('cache_misses_total', 'Total cache misses')
+rate_limit_rejections = Counter('rate_limit_rejections_total', 'Requests rejected by the rate limiter')
 
 app = FastAPI(
     title="SQL Chat Agent",
@@ -120,6 +124,26 @@ class RateLimiter:
 
 rate_limiter = RateLimiter(requests_per_minute=API["rate_limit_per_minute"])
 
+# Circuit breakers: after N consecutive failures, fail fast for a cool-off window
+# instead of letting every request wait out the full timeout on a dead backend
+query_breaker = pybreaker.CircuitBreaker(
+    fail_max=LLM["failure_threshold"],
+    reset_timeout=LLM["reset_timeout"],
+    name="query_pipeline"
+)
+schema_breaker = pybreaker.CircuitBreaker(
+    fail_max=LLM["failure_threshold"],
+    reset_timeout=LLM["reset_timeout"],
+    name="schema_info"
+)
+
+
+def _run_query_task(query: str, session_id: str, history: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Dispatch a query to Celery and wait for it; called through query_breaker,
+    so an open breaker sheds the request before anything is enqueued"""
+    task = process_query_task.delay(query, session_id, history)
+    return task.get(timeout=30)
+
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -140,7 +164,7 @@ class QueryRequest(BaseModel):
             raise ValueError('Query cannot be empty')
         if len(v) > 1000:
             raise ValueError('Query too long (max 1000 characters)')
-        if re.search(r'(DROP|DELETE|TRUNCATE|ALTER)\s+TABLE', v, re.IGNORECASE):
+        if _DDL_RE.search(v):
             raise ValueError('DDL operations not allowed')
         return v.strip()
 
@@ -181,6 +205,12 @@ async def global_exception_handler(request: Request, exc: Exception):
             status_code=503,
             content={"error": "AI service error", "detail": str(exc)}
         )
+    elif isinstance(exc, pybreaker.CircuitBreakerError):
+        return JSONResponse(
+            status_code=503,
+            content={"error": "Service temporarily unavailable", "detail": str(exc)},
+            headers={"Retry-After": str(LLM["reset_timeout"])}
+        )
     elif isinstance(exc, HTTPException):
         raise exc  # Let FastAPI handle it
     else:
@@ -190,31 +220,6 @@ async def global_exception_handler(request: Request, exc: Exception):
         )
 
 
-@app.middleware("http")
-async def add_process_time_header(request: Request, call_next):
-    """Middleware to add process time header and handle rate limiting"""
-    start_time = time.time()
-    client_ip = request.client.host
-
-    # Check rate limit
-    if request.url.path.startswith("/api/"):
-        if not await rate_limiter.check_rate_limit(client_ip):
-            return JSONResponse(
-                status_code=429,
-                content={"error": "Too many requests", "detail": "Please try again later"}
-            )
-
-    try:
-        response = await call_next(request)
-        process_time = time.time() - start_time
-        response.headers["X-Process-Time"] = str(process_time)
-        return response
-    except Exception as e:
-        logger.error(f"Error in middleware: {str(e)}")
-        error_counter.labels(error_type="middleware_error").inc()
-        raise
-
-
 
 class AccessTokenMiddleware:
     def __init__(self, app: FastAPI):
@@ -362,18 +367,16 @@ async def process_query(request: QueryRequest, background_tasks: BackgroundTasks
         active_sessions.inc()
 
         # Get conversation history
-        history = memory_service.get_conversation_history(session_id)
+        history = await memory_service.get_conversation_history(session_id)
 
-        # Submit task to Celery for async processing
-        task = process_query_task.delay(
-            request.query,
-            session_id,
-            history
-        )
-
-        # Wait for result with timeout
+        # Submit task to Celery and wait for the result, off the event loop and
+        # behind the breaker
         try:
-            result = task.get(timeout=30)
+            result = await asyncio.to_thread(
+                query_breaker.call, _run_query_task, request.query, session_id, history
+            )
+        except pybreaker.CircuitBreakerError:
+            raise
         except Exception as e:
             logger.error(f"Task timeout or error: {str(e)}")
             raise HTTPException(status_code=504, detail="Query processing timeout")
@@ -383,7 +386,7 @@ async def process_query(request: QueryRequest, background_tasks: BackgroundTasks
             raise HTTPException(status_code=500, detail=result["error"])
 
         # Store in conversation memory
-        memory_service.add_to_history(
+        await memory_service.add_to_history(
             session_id,
             request.query,
             result["answer"],
@@ -393,11 +396,13 @@ async def process_query(request: QueryRequest, background_tasks: BackgroundTasks
         # Generate suggestions in background
         suggestions = []
         if result.get("success", False):
-            suggestions = suggestion_service.generate_suggestions(
+            suggestions = await suggestion_service.generate_suggestions(
                 request.query,
                 result["answer"],
                 history
             )
+            # Warm suggestions for similar past exchanges once the response is sent
+            background_tasks.add_task(suggestion_service.prefetch_related, request.query, result["answer"])
 
         # Record query latency
         query_duration = time.time() - query_start_time
@@ -442,7 +447,7 @@ async def process_query(request: QueryRequest, background_tasks: BackgroundTasks
 
         return response_obj
 
-    except HTTPException:
+    except (HTTPException, pybreaker.CircuitBreakerError):
         raise
     except Exception as e:
         logger.error(f"Error processing query: {str(e)}")
@@ -476,11 +481,44 @@ async def visualization_recommendation(request: VisualizationRequest):
         )
 
 
+@app.post("/api/visualization-recommendations")
+async def visualization_recommendations(requests: List[VisualizationRequest]):
+    """Get visualization recommendations for several query results in one call"""
+    if len(requests) > LLM["visualization_batch_max_items"]:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {LLM['visualization_batch_max_items']} results per request"
+        )
+
+    try:
+        logger.info(f"Visualization recommendations requested for {len(requests)} results")
+
+        return await visualization_service.recommend_visualizations_batch(
+            [(request.question, request.sqlQuery, request.results) for request in requests]
+        )
+
+    except Exception as e:
+        logger.error(f"Error recommending visualizations: {str(e)}", exc_info=True)
+        error_counter.labels(error_type="visualization_error").inc()
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error generating visualization recommendations: {str(e)}"
+        )
+
+
 @app.get("/api/history/{session_id}")
-async def get_history(session_id: str):
+async def get_history(session_id: str, background_tasks: BackgroundTasks):
     """Get conversation history for a session"""
     try:
-        history = memory_service.get_conversation_history(session_id)
+        history = await memory_service.get_conversation_history(session_id)
+
+        # Warm the suggestion cache for the restored conversation in one LLM call
+        if history and CACHE["enable_llm_cache"]:
+            background_tasks.add_task(
+                suggestion_service.generate_suggestions_batch,
+                [(conv["query"], conv["answer"]) for conv in history[-3:]]
+            )
+
         return {"history": history}
     except Exception as e:
         logger.error(f"Error getting history: {str(e)}")
@@ -491,8 +529,10 @@ async def get_history(session_id: str):
 async def get_schema():
     """Get database schema information with caching"""
     try:
-        schema_info = sql_agent.get_schema_info()
+        schema_info = schema_breaker.call(sql_agent.get_schema_info)
         return {"schema": schema_info}
+    except pybreaker.CircuitBreakerError:
+        raise
     except DatabaseConnectionError as e:
         logger.error(f"Database connection error: {str(e)}")
         raise HTTPException(status_code=503, detail="Database unavailable")
@@ -510,43 +550,77 @@ async def health_check():
         "version": "1.0.0"
     }
 
-@app.get("/health/detailed")
-async def detailed_health_check():
-    """Detailed health check with component status"""
-    health_status = {
-        "timestamp": datetime.utcnow().isoformat(),
-        "status": "healthy",
-        "components": {}
-    }
-
-    # Check database connection
+@ttl_cache(maxsize=1, ttl=API["health_cache_ttl"])
+def _database_health() -> Dict[str, Any]:
+    """Probe the database via schema introspection, memoized so frequent health polls don't re-run it"""
     try:
         sql_agent.get_schema_info()
-        health_status["components"]["database"] = {"status": "healthy"}
+        return {"status": "healthy"}
     except Exception as e:
-        health_status["components"]["database"] = {"status": "unhealthy", "error": str(e)}
-        health_status["status"] = "unhealthy"
-    # Check Redis connection
+        return {"status": "unhealthy", "error": str(e)}
+
+
+@ttl_cache(maxsize=1, ttl=API["health_cache_ttl"])
+def _disk_percent() -> float:
+    """Root filesystem usage, memoized alongside the database probe"""
+    return psutil.disk_usage('/').percent
+
+
+def _redis_health() -> Dict[str, Any]:
+    """Ping Redis through the memory service client"""
     try:
         memory_service.redis_client.ping()
-        health_status["components"]["redis"] = {"status": "healthy"}
+        return {"status": "healthy"}
     except Exception as e:
-        health_status["components"]["redis"] = {"status": "unhealthy", "error": str(e)}
-        health_status["status"] = "unhealthy"
+        return {"status": "unhealthy", "error": str(e)}
 
-    # Check system resources
-    health_status["components"]["system"] = {
+
+def _system_health() -> Dict[str, Any]:
+    """Collect CPU, memory and disk usage"""
+    system = {
         "status": "healthy",
         "cpu_percent": psutil.cpu_percent(),
         "memory_percent": psutil.virtual_memory().percent,
-        "disk_percent": psutil.disk_usage('/').percent
+        "disk_percent": _disk_percent()
     }
 
-    if health_status["components"]["system"]["cpu_percent"] > 90:
-        health_status["components"]["system"]["status"] = "warning"
+    if system["cpu_percent"] > 90:
+        system["status"] = "warning"
+
+    if system["memory_percent"] > 90:
+        system["status"] = "warning"
+
+    return system
 
-    if health_status["components"]["system"]["memory_percent"] > 90:
-        health_status["components"]["system"]["status"] = "warning"
+
+@app.get("/health/detailed")
+async def detailed_health_check():
+    """Detailed health check with component status"""
+    health_status = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "status": "healthy",
+        "components": {}
+    }
+
+    # All probes do blocking I/O or syscalls: run them concurrently in threads
+    # so a slow component neither blocks the event loop nor delays the others
+    database, redis_status, system = await asyncio.gather(
+        asyncio.to_thread(_database_health),
+        asyncio.to_thread(_redis_health),
+        asyncio.to_thread(_system_health),
+        return_exceptions=True
+    )
+
+    for name, component in (("database", database), ("redis", redis_status)):
+        if isinstance(component, Exception):
+            component = {"status": "unhealthy", "error": str(component)}
+        health_status["components"][name] = dict(component)
+        if component["status"] != "healthy":
+            health_status["status"] = "unhealthy"
+
+    if isinstance(system, Exception):
+        system = {"status": "warning", "error": str(system)}
+    health_status["components"]["system"] = system
 
     return health_status
 
@@ -557,11 +631,23 @@ async def metrics():
     """Prometheus metrics endpoint"""
     return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
+def _rate_limit_key(request: Request) -> str:
+    """Rate limits are per client IP. Authentication is bypassed, so there is no
+    validated user to key by; the user_email/access_token cookies are
+    client-controlled and could be rotated per request"""
+    client_ip = request.client.host if request.client else "unknown"
+    if API["trusted_proxy"]:
+        # Behind a reverse proxy every request comes from the proxy's address
+        forwarded_for = request.headers.get("x-forwarded-for")
+        if forwarded_for:
+            client_ip = forwarded_for.split(",")[0].strip()
+    return f"ip:{client_ip}"
+
+
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
     """Middleware to add process time header and handle rate limiting"""
     start_time = time.time()
-    client_ip = request.client.host
 
     # Skip rate limiting for metrics endpoint
     if request.url.path == "/metrics":
@@ -570,10 +656,12 @@ async def add_process_time_header(request: Request, call_next):
 
     # Check rate limit for API endpoints
     if request.url.path.startswith("/api/"):
-        if not await rate_limiter.check_rate_limit(client_ip):
+        if not await rate_limiter.check_rate_limit(_rate_limit_key(request)):
+            rate_limit_rejections.inc()
             return JSONResponse(
                 status_code=429,
-                content={"error": "Too many requests", "detail": "Please try again later"}
+                content={"error": "Too many requests", "detail": "Please try again later"},
+                headers={"Retry-After": "60"}
             )
 
     try:
@@ -625,3 +713,5 @@ async def startup_event():
     except Exception as e:
         logger.error(f"Failed to connect to Redis during startup: {str(e)}")
 
+    if LLM["warmup_on_startup"]:
+        await visualization_service.warmup()
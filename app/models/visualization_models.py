@@ -1,4 +1,4 @@
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Literal, Union
 from pydantic import BaseModel, Field
 
 class ChartConfig(BaseModel):
@@ -26,6 +26,33 @@ class VisualizationRecommendation(BaseModel):
     reasoning: Optional[str] = None
     data_transformation: Optional[DataTransformation] = None
 
+# Chart types the recommendation prompt offers
+VisualizationType = Literal[
+    "bar_chart", "line_chart", "pie_chart", "scatter_plot", "table",
+    "area_chart", "horizontal_bar", "stacked_bar", "donut_chart", "heatmap", "kpi"
+]
+
+class LLMChartConfig(BaseModel):
+    # Explicitly typed subset of ChartConfig, so it can be used as a structured-output schema
+    title: Optional[str] = None
+    x_axis: Optional[str] = None
+    y_axis: Optional[Union[str, List[str]]] = None
+    series: Optional[Union[str, List[str]]] = None
+    labels_col: Optional[str] = None
+    values_col: Optional[str] = None
+    value_col: Optional[str] = None
+    subtitle: Optional[str] = None
+
+class LLMVizOutput(BaseModel):
+    # Shape the LLM must answer with (passed as response_format)
+    visualization_type: VisualizationType
+    config: LLMChartConfig
+    # Optional like VisualizationRecommendation.reasoning, so a JSON-mode reply
+    # without it is still usable. Strict-schema providers get it as a required,
+    # nullable property (like the other optional fields), so they still fill it in
+    reasoning: Optional[str] = None
+    data_transformation: Optional[DataTransformation] = None
+
 # Example usage (optional, for testing):
 if __name__ == "__main__":
     # Example for a bar chart
@@ -1,41 +1,210 @@
 import redis
 import json
 import uuid
-from typing import List, Dict, Any, Optional
-from datetime import datetime, date, timedelta  # Add timedelta here
+from typing import List, Dict, Any, Optional, Union
+from datetime import datetime, date
 import os
 import logging
+import threading
+import weakref
+import asyncio
 from functools import wraps
 import time
+from cachetools import TTLCache
+import msgspec
+import xxhash
+import zstandard
+from prometheus_client import Counter, Histogram, Gauge
 
-from app.config import REDIS, MEMORY, CACHE
+from app.config import REDIS, MEMORY, CACHE, LLM
+from app.services.redis_pool import get_redis, get_async_redis
 
 logger = logging.getLogger(__name__)
 
+# Metrics
+cache_hits = Counter('cache_hits_total', 'Total cache hits')
+cache_misses = Counter('cache_misses_total', 'Total cache misses')
+memory_retrieval_counter = Counter(
+    'llm_memory_retrieval_total', 'Memory retrievals by cache tier and outcome', ['tier', 'status']
+)
+memory_retrieval_latency = Histogram(
+    'llm_memory_retrieval_latency_seconds', 'Memory retrieval latency', ['tier'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+memory_history_len = Gauge('memory_history_len', 'Length of the most recently loaded conversation history')
+
+# Appends a conversation, trims/expires the history list and bumps the session
+# hash in one atomic server-side step (one round-trip, no query_count race).
+# Sessions written before the hash layout (JSON strings) are converted in place.
+# KEYS[1] = history key, KEYS[2] = session key
+# ARGV[1] = conversation JSON, ARGV[2] = last index to keep, ARGV[3] = TTL seconds,
+# ARGV[4] = last activity timestamp (epoch ms)
+ADD_TO_HISTORY_LUA = """
+redis.call('LPUSH', KEYS[1], ARGV[1])
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[2]))
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[3]))
+local kind = redis.call('TYPE', KEYS[2])['ok']
+if kind == 'string' then
+    local legacy = cjson.decode(redis.call('GET', KEYS[2]))
+    redis.call('DEL', KEYS[2])
+    redis.call('HSET', KEYS[2], 'created_at', legacy['created_at'] or ARGV[4],
+               'query_count', legacy['query_count'] or 0)
+    kind = 'hash'
+end
+if kind == 'hash' then
+    redis.call('HSET', KEYS[2], 'last_activity', ARGV[4])
+    redis.call('HINCRBY', KEYS[2], 'query_count', 1)
+    redis.call('EXPIRE', KEYS[2], tonumber(ARGV[3]))
+end
+return 1
+"""
+
+# Returns a session's history only while the session itself still exists,
+# checked and read atomically in a single round-trip.
+# KEYS[1] = session key, KEYS[2] = history key
+GET_HISTORY_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {}
+end
+return redis.call('LRANGE', KEYS[2], 0, -1)
+"""
+
 def json_serialize(obj):
     """JSON serializer for objects not serializable by default json code"""
     if isinstance(obj, (datetime, date)):
         return obj.isoformat()
     return str(obj)
 
+
+def _now_ms() -> int:
+    """Current time as integer epoch milliseconds (what session data stores)"""
+    return time.time_ns() // 1_000_000
+
+
+def _parse_ts(value: Optional[str]) -> Union[int, str, None]:
+    """Session hash fields come back as strings; epoch-ms values are returned as ints"""
+    return int(value) if value and value.isdigit() else value
+
+
+def cache_digest(*parts: str) -> str:
+    """Stable digest for cache keys (builtin hash() is salted per process)"""
+    return xxhash.xxh3_64_hexdigest("\x1f".join(parts))
+
+
+# SQLAgent builds its prompt context from the last 5 turns
+_HISTORY_KEY_TURNS = 5
+
+
+def query_cache_key(query: str, history: Optional[List[Dict[str, Any]]] = None) -> str:
+    """Content-addressed cache key for a query result.
+
+    The query is normalized by whitespace and case; the model and the recent
+    turns are part of the digest because the generated SQL and answer depend
+    on them ("break that down by region" means different things in different
+    conversations). Sessions share an entry only when both match.
+    """
+    normalized_query = " ".join(query.lower().split())
+    turns = [
+        part
+        for conv in (history or [])[-_HISTORY_KEY_TURNS:]
+        for part in (conv.get("query") or "", conv.get("answer") or "", conv.get("sql_query") or "")
+    ]
+    return f"query_result:{cache_digest(normalized_query, LLM['model'], *turns)}"
+
+
+class Conversation(msgspec.Struct):
+    """One question/answer exchange as stored in a session's history list"""
+    # Epoch ms; entries written before the switch carry an ISO string
+    timestamp: Union[int, str]
+    query: str
+    answer: str
+    sql_query: Optional[str] = None
+
+
+# Redis payloads are msgpack-encoded; entries written as JSON before the switch
+# are still read through the json fallback in the decode helpers below
+_msgpack_encoder = msgspec.msgpack.Encoder(enc_hook=json_serialize)
+_conversation_decoder = msgspec.msgpack.Decoder(Conversation)
+_result_decoder = msgspec.msgpack.Decoder()
+
+# Large results from the Celery worker are stored as zstd frames
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def _decompress(raw: bytes) -> bytes:
+    """Inflate a zstd-compressed payload; anything else is returned unchanged"""
+    if raw[:4] == _ZSTD_MAGIC:
+        # Decompressor objects are not safe to share between threads
+        return zstandard.ZstdDecompressor().decompress(raw)
+    return raw
+
+
+def decode_query_result(raw: bytes) -> Dict[str, Any]:
+    """Decode a cached query result, whichever of zstd/msgpack/JSON it was written as"""
+    raw = _decompress(raw)
+    try:
+        return _result_decoder.decode(raw)
+    except msgspec.DecodeError:
+        return json.loads(raw)
+
+
+def fetch_cached_query(redis_client: redis.Redis, cache_key: str,
+                       local_cache: Optional[TTLCache] = None) -> Optional[Dict[str, Any]]:
+    """Read a cached query result, from local_cache first when given and then
+    Redis, recording the query-tier hit/miss metrics"""
+    start_time = time.perf_counter()
+    result = local_cache.get(cache_key) if local_cache is not None else None
+    if result is None:
+        try:
+            raw = redis_client.get(cache_key)
+            memory_retrieval_latency.labels(tier="query").observe(time.perf_counter() - start_time)
+            if raw:
+                result = decode_query_result(raw)
+                if local_cache is not None:
+                    local_cache[cache_key] = result
+        except Exception as e:
+            logger.warning(f"Failed to read cached query result: {str(e)}")
+
+    if result is None:
+        cache_misses.inc()
+        memory_retrieval_counter.labels(tier="query", status="miss").inc()
+    else:
+        cache_hits.inc()
+        memory_retrieval_counter.labels(tier="query", status="hit").inc()
+    return result
+
 def with_redis_fallback(func):
-    """Decorator to handle Redis connection failures gracefully"""
+    """Decorator to handle Redis connection failures gracefully (sync or async methods)"""
+
+    def fallback(e):
+        logger.error(f"Redis connection error in {func.__name__}: {str(e)}")
+        # Return sensible defaults instead of failing
+        if func.__name__ == 'get_conversation_history':
+            return []
+        elif func.__name__ == 'create_session':
+            return str(uuid.uuid4())
+        else:
+            return None
+
+    if asyncio.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(self, *args, **kwargs):
+            try:
+                return await func(self, *args, **kwargs)
+            except redis.exceptions.ConnectionError as e:
+                return fallback(e)
+            except Exception as e:
+                logger.error(f"Unexpected error in {func.__name__}: {str(e)}")
+                raise
+
+        return async_wrapper
 
     @wraps(func)
     def wrapper(self, *args, **kwargs):
         try:
             return func(self, *args, **kwargs)
         except redis.exceptions.ConnectionError as e:
-            logger.error(f"Redis connection error in {func.__name__}: {str(e)}")
-            # Return sensible defaults instead of failing
-            if func.__name__ == 'get_conversation_history':
-                return []
-            elif func.__name__ == 'create_session':
-                return str(uuid.uuid4())
-            elif func.__name__ == 'get_cached_query':
-                return None
-            else:
-                return None
+            return fallback(e)
         except Exception as e:
             logger.error(f"Unexpected error in {func.__name__}: {str(e)}")
             raise
@@ -51,21 +220,25 @@ class MemoryService:
         self.max_retries = MEMORY["max_retries"]
         self.retry_delay = MEMORY["retry_delay"]
 
+        # Short-lived in-process cache for bursty follow-up queries in the same session
+        self._history_cache = TTLCache(
+            maxsize=MEMORY["history_cache_size"],
+            ttl=MEMORY["history_cache_ttl"]
+        )
+        self._history_cache_lock = threading.Lock()
+
+        # History scripts registered per async client (i.e. per event loop)
+        self._async_scripts = weakref.WeakKeyDictionary()
+
         self._connect_with_retry()
 
     def _connect_with_retry(self):
         """Connect to Redis with retry logic"""
         for attempt in range(self.max_retries):
             try:
-                self.redis_client = redis.Redis(
-                    host=REDIS["host"],
-                    port=REDIS["port"],
-                    decode_responses=True,
-                    socket_timeout=5,
-                    socket_connect_timeout=5,
-                    retry_on_timeout=True,
-                    health_check_interval=30
-                )
+                self.redis_client = get_redis()
+                # Binary-safe client for msgpack payloads
+                self.raw_redis_client = get_redis(decode_responses=False)
                 # Test connection
                 self.redis_client.ping()
                 logger.info("Successfully connected to Redis")
@@ -78,6 +251,23 @@ class MemoryService:
                     logger.error(f"Failed to connect to Redis after {self.max_retries} attempts")
                     # Create a dummy client that will fail operations gracefully
                     self.redis_client = None
+                    self.raw_redis_client = None
+
+    def _history_scripts(self):
+        """(add, get) history scripts bound to the async client of the running event loop"""
+        client = get_async_redis(decode_responses=False)
+        scripts = self._async_scripts.get(client)
+        if scripts is None:
+            scripts = self._async_scripts[client] = (
+                client.register_script(ADD_TO_HISTORY_LUA),
+                client.register_script(GET_HISTORY_LUA)
+            )
+        return scripts
+
+    def _invalidate_history_cache(self, session_id: str):
+        """Drop the in-process history entry for a session"""
+        with self._history_cache_lock:
+            self._history_cache.pop(session_id, None)
 
     @with_redis_fallback
     def create_session(self) -> str:
@@ -85,17 +275,17 @@ class MemoryService:
         session_id = str(uuid.uuid4())
 
         try:
-            session_data = {
-                "created_at": datetime.utcnow().isoformat(),
-                "last_activity": datetime.utcnow().isoformat(),
-                "query_count": 0
-            }
+            now = _now_ms()
+            session_key = f"session:{session_id}"
 
-            self.redis_client.setex(
-                f"session:{session_id}",
-                self.session_ttl,
-                json.dumps(session_data)
-            )
+            pipe = self.redis_client.pipeline()
+            pipe.hset(session_key, mapping={
+                "created_at": now,
+                "last_activity": now,
+                "query_count": 0
+            })
+            pipe.expire(session_key, self.session_ttl)
+            pipe.execute()
 
             logger.info(f"Created new session: {session_id}")
             return session_id
@@ -104,36 +294,32 @@ class MemoryService:
             logger.error(f"Error creating session: {str(e)}")
             return session_id  # Return the ID even if Redis fails
 
-    def add_to_history(self, session_id: str, query: str, answer: str, sql_query: str):
+    async def add_to_history(self, session_id: str, query: str, answer: str, sql_query: str):
         """Add a conversation to history with error handling"""
         try:
             history_key = f"history:{session_id}"
 
             # Create conversation entry
-            conversation = {
-                "timestamp": datetime.utcnow().isoformat(),
-                "query": query,
-                "answer": answer,
-                "sql_query": sql_query
-            }
-
-            # Add to Redis list
-            self.redis_client.lpush(history_key, json.dumps(conversation))
-
-            # Trim to keep only last N conversations
-            # This is the key line to ensure we keep the last 5 conversations
-            self.redis_client.ltrim(history_key, 0, self.history_limit - 1)
-
-            # Set expiry on the history
-            self.redis_client.expire(history_key, self.session_ttl)
+            conversation = Conversation(
+                timestamp=_now_ms(),
+                query=query,
+                answer=answer,
+                sql_query=sql_query
+            )
 
-            # Update session info
-            session_key = f"session:{session_id}"
-            if self.redis_client.exists(session_key):
-                session_data = json.loads(self.redis_client.get(session_key))
-                session_data["last_activity"] = datetime.utcnow().isoformat()
-                session_data["query_count"] = session_data.get("query_count", 0) + 1
-                self.redis_client.setex(session_key, self.session_ttl, json.dumps(session_data))
+            # Push, trim to the last N conversations, refresh TTL and update
+            # session info atomically on the server
+            add_history_script, _ = self._history_scripts()
+            await add_history_script(
+                keys=[history_key, f"session:{session_id}"],
+                args=[
+                    _msgpack_encoder.encode(conversation),
+                    self.history_limit - 1,
+                    self.session_ttl,
+                    _now_ms()
+                ]
+            )
+            self._invalidate_history_cache(session_id)
 
             logger.debug(f"Added conversation to history for session {session_id}")
 
@@ -141,75 +327,60 @@ class MemoryService:
             logger.error(f"Error adding to history: {str(e)}")
 
     @with_redis_fallback
-    def get_conversation_history(self, session_id: str) -> List[Dict[str, Any]]:
+    async def get_conversation_history(self, session_id: str) -> List[Dict[str, Any]]:
         """Get conversation history with error handling"""
+        start_time = time.perf_counter()
         try:
-            history_key = f"history:{session_id}"
-
-            # Check if session exists
-            if not self.redis_client.exists(f"session:{session_id}"):
-                logger.warning(f"Session {session_id} does not exist")
-                return []
-
-            # Get history from Redis
-            history_raw = self.redis_client.lrange(history_key, 0, -1)
+            with self._history_cache_lock:
+                cached = self._history_cache.get(session_id)
+            if cached is not None:
+                memory_retrieval_counter.labels(tier="history", status="hit").inc()
+                memory_retrieval_latency.labels(tier="history").observe(time.perf_counter() - start_time)
+                return list(cached)
+            memory_retrieval_counter.labels(tier="history", status="miss").inc()
+
+            # Get history from Redis (empty when the session has expired or was cleared)
+            _, get_history_script = self._history_scripts()
+            history_raw = await get_history_script(
+                keys=[f"session:{session_id}", f"history:{session_id}"]
+            )
 
             # Parse and reverse to get chronological order
             history = []
             for item in reversed(history_raw):
                 try:
-                    history.append(json.loads(item))
-                except json.JSONDecodeError as e:
-                    logger.warning(f"Failed to parse history item: {str(e)}")
-                    continue
+                    history.append(msgspec.structs.asdict(_conversation_decoder.decode(item)))
+                except msgspec.DecodeError:
+                    try:
+                        history.append(json.loads(item))
+                    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                        logger.warning(f"Failed to parse history item: {str(e)}")
+                        continue
+
+            with self._history_cache_lock:
+                self._history_cache[session_id] = history
 
-            return history
+            memory_history_len.set(len(history))
+            memory_retrieval_latency.labels(tier="history").observe(time.perf_counter() - start_time)
+            return list(history)
 
         except Exception as e:
             logger.error(f"Error getting conversation history: {str(e)}")
             return []
 
     @with_redis_fallback
-    def get_cached_query(self, session_id: str, query: str) -> Optional[Dict[str, Any]]:
-        """Get cached query result with error handling"""
-        try:
-            # Normalize query by removing whitespace and converting to lowercase
-            normalized_query = " ".join(query.lower().split())
-
-            # Use a simple hash function less prone to variation
-            import hashlib
-            query_hash = hashlib.md5(normalized_query.encode()).hexdigest()
-
-            cache_key = f"query_result:{session_id}:{query_hash}"
-
-            cached_result = self.redis_client.get(cache_key)
-            if cached_result:
-                try:
-                    logger.info(f"Cache hit for query in session {session_id}")
-                    return json.loads(cached_result)
-                except json.JSONDecodeError as e:
-                    logger.warning(f"Failed to parse cached query: {str(e)}")
-                    return None
-            return None
-
-        except Exception as e:
-            logger.error(f"Error getting cached query: {str(e)}")
-            return None
-
-    @with_redis_fallback
-    def cache_query_result(self, session_id: str, query: str, result: Dict[str, Any], ttl: int = None):
+    def cache_query_result(self, session_id: str, query: str, result: Dict[str, Any],
+                           history: Optional[List[Dict[str, Any]]] = None, ttl: int = None):
         """Cache a query result with error handling"""
         if ttl is None:
             ttl = CACHE["query_cache_ttl"]
 
         try:
-            cache_key = f"query_result:{session_id}:{hash(query)}"
-
-            self.redis_client.setex(
-                cache_key,
-                ttl,
-                json.dumps(result)
-            )
+            # Entries may be shared with other sessions that reached the same
+            # conversation state, so they are left to expire rather than indexed
+            # per session for deletion
+            cache_key = query_cache_key(query, history)
+            self.raw_redis_client.setex(cache_key, ttl, _msgpack_encoder.encode(result))
 
             logger.debug(f"Cached query result for session {session_id}")
 
@@ -220,25 +391,21 @@ class MemoryService:
     def get_session_stats(self, session_id: str) -> Dict[str, Any]:
         """Get statistics for a session with error handling"""
         try:
-            history_key = f"history:{session_id}"
             session_key = f"session:{session_id}"
 
-            total_queries = self.redis_client.llen(history_key)
-
-            # Get session data
-            session_data = None
-            if self.redis_client.exists(session_key):
-                try:
-                    session_data = json.loads(self.redis_client.get(session_key))
-                except json.JSONDecodeError:
-                    session_data = None
+            # One round-trip; HGETALL returns an empty dict when the session is gone.
+            # query_count is the lifetime total, unlike the trimmed history list
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.hgetall(session_key)
+            pipe.ttl(session_key)
+            session_data, ttl = pipe.execute()
 
             stats = {
                 "session_id": session_id,
-                "total_queries": total_queries,
-                "created_at": session_data.get("created_at") if session_data else None,
-                "last_activity": session_data.get("last_activity") if session_data else None,
-                "ttl": self.redis_client.ttl(session_key)
+                "total_queries": int(session_data.get("query_count", 0)) if session_data else 0,
+                "created_at": _parse_ts(session_data.get("created_at")) if session_data else None,
+                "last_activity": _parse_ts(session_data.get("last_activity")) if session_data else None,
+                "ttl": ttl
             }
 
             return stats
@@ -260,17 +427,15 @@ class MemoryService:
             session_key = f"session:{session_id}"
             history_key = f"history:{session_id}"
 
-            if self.redis_client.exists(session_key):
-                # Update last activity
-                session_data = json.loads(self.redis_client.get(session_key))
-                session_data["last_activity"] = datetime.utcnow().isoformat()
-
-                # Extend TTL
-                self.redis_client.setex(session_key, self.session_ttl, json.dumps(session_data))
-
-                if self.redis_client.exists(history_key):
-                    self.redis_client.expire(history_key, self.session_ttl)
+            # Activity is already stamped by add_to_history; only the TTLs move here.
+            # EXPIRE is a no-op on a missing key, so all go out in one pipeline and
+            # every per-session key follows the session hash's TTL
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.expire(session_key, self.session_ttl)
+            pipe.expire(history_key, self.session_ttl)
+            session_extended, _ = pipe.execute()
 
+            if session_extended:
                 logger.debug(f"Extended session {session_id}")
             else:
                 logger.warning(f"Attempted to extend non-existent session {session_id}")
@@ -282,15 +447,16 @@ class MemoryService:
     def clear_session(self, session_id: str):
         """Clear a session and its history with error handling"""
         try:
-            # Delete session and history
-            self.redis_client.delete(f"session:{session_id}")
-            self.redis_client.delete(f"history:{session_id}")
-
-            # Delete any cached queries for this session
-            pattern = f"query_result:{session_id}:*"
-            keys = self.redis_client.keys(pattern)
-            if keys:
-                self.redis_client.delete(*keys)
+            self._invalidate_history_cache(session_id)
+
+            # Delete session and history in one round-trip. Cached query results
+            # are shared across sessions and keyed by history, so they stay; only
+            # a query index left by older versions is dropped
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.delete(f"session:{session_id}")
+            pipe.delete(f"history:{session_id}")
+            pipe.delete(f"session_queries:{session_id}")
+            pipe.execute()
 
             logger.info(f"Cleared session {session_id}")
 
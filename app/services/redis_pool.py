@@ -0,0 +1,75 @@
+import asyncio
+import weakref
+from typing import Dict
+
+import redis
+import redis.asyncio as aioredis
+
+from app.config import REDIS
+
+# Process-wide pools shared by every service, so concurrent requests reuse the
+# same sockets instead of each service opening its own. A blocking pool waits
+# (up to `timeout`) for a free connection rather than failing under contention.
+POOL = redis.BlockingConnectionPool.from_url(
+    REDIS["url"],
+    max_connections=REDIS["max_connections"],
+    timeout=5,
+    decode_responses=True,
+    socket_timeout=5,
+    socket_connect_timeout=5,
+    socket_keepalive=True,
+    retry_on_timeout=True,
+    health_check_interval=30
+)
+
+# Same settings without response decoding, for binary (msgpack) payloads
+RAW_POOL = redis.BlockingConnectionPool.from_url(
+    REDIS["url"],
+    max_connections=REDIS["max_connections"],
+    timeout=5,
+    socket_timeout=5,
+    socket_connect_timeout=5,
+    socket_keepalive=True,
+    retry_on_timeout=True,
+    health_check_interval=30
+)
+
+
+def get_redis(decode_responses: bool = True) -> redis.Redis:
+    """Return a Redis client backed by the shared connection pool"""
+    return redis.Redis(connection_pool=POOL if decode_responses else RAW_POOL)
+
+
+# asyncio connections are bound to the event loop that opened them, so async
+# clients (and their pools) are kept per loop: one for the API server, and a
+# short-lived one for each asyncio.run() in a Celery task, which must call
+# close_async_redis() before its loop ends
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[bool, aioredis.Redis]]" = \
+    weakref.WeakKeyDictionary()
+
+
+def get_async_redis(decode_responses: bool = True) -> aioredis.Redis:
+    """Return an asyncio Redis client backed by a shared pool for the running event loop"""
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(decode_responses)
+    if client is None:
+        pool = aioredis.BlockingConnectionPool.from_url(
+            REDIS["url"],
+            max_connections=REDIS["max_connections"],
+            timeout=5,
+            decode_responses=decode_responses,
+            socket_timeout=5,
+            socket_connect_timeout=5,
+            socket_keepalive=True,
+            retry_on_timeout=True,
+            health_check_interval=30
+        )
+        client = clients[decode_responses] = aioredis.Redis(connection_pool=pool)
+    return client
+
+
+async def close_async_redis():
+    """Close the running loop's async clients and their pools (for short-lived loops)"""
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.aclose(close_connection_pool=True)
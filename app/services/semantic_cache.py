@@ -0,0 +1,114 @@
+from array import array
+from typing import Dict, List, Optional
+import json
+import logging
+
+import litellm
+import redis
+from redis.commands.search.field import VectorField
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+
+from app.config import CACHE
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """Nearest-neighbour cache over embeddings, stored as Redis hashes and
+    searched through a RediSearch HNSW index.
+
+    Every operation degrades to a miss when RediSearch or the embedding
+    endpoint is unavailable, so callers can always fall through to the LLM.
+    """
+
+    def __init__(self, redis_client: redis.Redis, index_name: str, prefix: str, ttl: int):
+        self.redis_client = redis_client
+        self.index_name = index_name
+        self.prefix = prefix
+        self.ttl = ttl
+        self.threshold = CACHE["semantic_cache_threshold"]
+        self.embedding_model = CACHE["embedding_model"]
+        self.embedding_dim = CACHE["embedding_dim"]
+        self.enabled = CACHE["semantic_cache_enabled"] and self._ensure_index()
+
+    def _ensure_index(self) -> bool:
+        """Create the vector index if it does not exist yet"""
+        index = self.redis_client.ft(self.index_name)
+        try:
+            index.info()
+            return True
+        except redis.exceptions.ResponseError:
+            pass  # Unknown index (or no RediSearch, which create_index reports below)
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Semantic cache disabled, Redis unavailable: {str(e)}")
+            return False
+
+        try:
+            index.create_index(
+                [VectorField("embedding", "HNSW", {
+                    "TYPE": "FLOAT32",
+                    "DIM": self.embedding_dim,
+                    "DISTANCE_METRIC": "COSINE"
+                })],
+                definition=IndexDefinition(prefix=[self.prefix], index_type=IndexType.HASH)
+            )
+            logger.info(f"Created semantic cache index {self.index_name}")
+            return True
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Semantic cache disabled, could not create index {self.index_name}: {str(e)}")
+            return False
+
+    def embed(self, text: str) -> Optional[bytes]:
+        """Embed text and pack it as a FLOAT32 blob for the vector index"""
+        try:
+            response = litellm.embedding(model=self.embedding_model, input=[text])
+            return array("f", response.data[0]["embedding"]).tobytes()
+        except Exception as e:
+            logger.warning(f"Embedding failed, skipping semantic cache: {str(e)}")
+            return None
+
+    def _search(self, vector: bytes, k: int, fields: List[str]) -> list:
+        """Run a KNN query and return the matching documents, closest first"""
+        query = (
+            Query(f"*=>[KNN {k} @embedding $vec AS score]")
+            .sort_by("score")
+            .return_fields(*fields, "score")
+            .dialect(2)
+        )
+        try:
+            return self.redis_client.ft(self.index_name).search(query, query_params={"vec": vector}).docs
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Semantic cache search failed: {str(e)}")
+            return []
+
+    def lookup(self, vector: bytes) -> Optional[List[str]]:
+        """Return the cached value of the nearest neighbour if it is similar enough"""
+        docs = self._search(vector, 1, ["value"])
+        if not docs:
+            return None
+
+        # COSINE distance is 1 - cosine similarity
+        doc = docs[0]
+        if 1 - float(doc.score) < self.threshold:
+            return None
+
+        try:
+            return json.loads(doc.value)
+        except (json.JSONDecodeError, AttributeError):
+            return None
+
+    def neighbours(self, vector: bytes, k: int, fields: List[str]) -> List[Dict[str, Optional[str]]]:
+        """Return the requested fields of the k nearest entries, regardless of threshold"""
+        return [{field: getattr(doc, field, None) for field in fields} for doc in self._search(vector, k, fields)]
+
+    def store(self, key: str, vector: bytes, value: List[str], metadata: Optional[Dict[str, str]] = None):
+        """Store a value (plus optional metadata fields) under its embedding with the cache TTL"""
+        cache_key = f"{self.prefix}{key}"
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.hset(cache_key, mapping={"embedding": vector, "value": json.dumps(value), **(metadata or {})})
+            pipe.expire(cache_key, self.ttl)
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Semantic cache store failed: {str(e)}")
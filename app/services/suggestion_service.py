@@ -1,52 +1,24 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple, Callable, TypeVar
 import os
+import asyncio
 import litellm
-from langchain.prompts import ChatPromptTemplate
-from langchain.schema import SystemMessage, HumanMessage
 import json
-import redis
+import re
+import logging
+from prometheus_client import Counter
 
-from app.config import REDIS, LLM, CACHE
+from app.config import LLM, CACHE
+from app.services.redis_pool import get_redis, get_async_redis
+from app.services.memory_service import cache_digest
+from app.services.semantic_cache import SemanticCache
 
+logger = logging.getLogger(__name__)
 
-class SuggestionService:
-    def __init__(self):
-        # Configure LiteLLM directly instead of using LangChain integration
-        litellm.api_key = LLM["api_key"]
-        litellm.api_base = LLM["api_base"]
-
-        # Set custom headers if provided
-        if LLM["auth_header"]:
-            litellm.headers = {"Authorization": LLM["auth_header"]}
-
-        # Store model name and temperature for later use
-        self.model = LLM["model"]
-        self.temperature = LLM["suggestion_temperature"]
-
-        self.redis_client = redis.Redis.from_url(
-            REDIS["url"],
-            decode_responses=True
-        )
-        self.suggestion_cache_ttl = CACHE["llm_cache_ttl"]
-
-    def generate_suggestions(self, query: str, answer: str, history: List[Dict[str, Any]]) -> List[str]:
-        """Generate follow-up suggestions based on the current context"""
-
-        # Check cache first if caching is enabled
-        if CACHE["enable_llm_cache"]:
-            cache_key = f"suggestions:{hash(query + answer)}"
-            cached_suggestions = self.redis_client.get(cache_key)
-            if cached_suggestions:
-                try:
-                    return json.loads(cached_suggestions)
-                except json.JSONDecodeError:
-                    pass
-
-        # Build context from history
-        context = self._build_context(history)
+T = TypeVar("T")
 
-        # Create prompt
-        prompt_content = f"""You are a Net Promoter Score (NPS) analytics expert that suggests relevant follow-up questions to help users gain more insights from their NPS data.
+# Static instructions, sent as an identical system message on every call so
+# provider-side prompt caching can reuse the prefix
+SUGGESTION_SYSTEM_PROMPT = """You are a Net Promoter Score (NPS) analytics expert that suggests relevant follow-up questions to help users gain more insights from their NPS data.
 
 Based on the current conversation, suggest 3 relevant follow-up questions that would help the user dive deeper into the NPS data.
 
@@ -84,66 +56,275 @@ Net Promoter Score (NPS) is a customer loyalty metric ranging from -100 to +100:
 
 Make suggestions specific, actionable, and follow the user's current analytical thread.
 Each suggestion should be a complete question related to NPS.
-Keep each question concise (under 15 words if possible).
+Keep each question concise (under 15 words if possible)."""
 
-Current query: {query}
-Answer: {answer}
-Recent conversation context: {context}
+# Metrics
+suggestion_model_results = Counter(
+    'suggestion_model_results_total', 'Suggestion completions per model and outcome', ['model', 'outcome']
+)
 
-Generate 3 follow-up NPS-related questions:"""
+# Separates per-item sections in a batched suggestion response
+_BATCH_ITEM_RE = re.compile(r'^[ \t]*=== ITEM (\d+) ===[ \t]*$', re.MULTILINE)
 
-        # Call LiteLLM directly
-        try:
-            response = litellm.completion(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt_content}],
-                temperature=self.temperature
-            )
+# A question line, with any leading numbering ("1.", "2)") or bullets stripped
+_SUGGESTION_RE = re.compile(r'^[ \t]*(?:(?:\d+[.)]|[-*•])[ \t]*)*(.*\?.*?)[ \t]*$', re.MULTILINE)
+
+
+class SuggestionService:
+    def __init__(self):
+        # Configure LiteLLM directly instead of using LangChain integration
+        litellm.api_key = LLM["api_key"]
+        litellm.api_base = LLM["api_base"]
+
+        # Set custom headers if provided
+        if LLM["auth_header"]:
+            litellm.headers = {"Authorization": LLM["auth_header"]}
+
+        # Store model name and temperature for later use
+        self.model = LLM["model"]
+        self.temperature = LLM["suggestion_temperature"]
+        self.models = LLM["suggestion_models"] or [self.model]
+        self._system_messages = {
+            model: self._build_system_message(model) for model in {self.model, *self.models}
+        }
+
+        self.redis_client = get_redis()
+        self.suggestion_cache_ttl = CACHE["llm_cache_ttl"]
+        self._prefetch_semaphore = asyncio.Semaphore(CACHE["prefetch_concurrency"])
+
+        # Catches paraphrased questions that miss the exact-match cache
+        self.semantic_cache = SemanticCache(
+            self.redis_client,
+            index_name="idx:suggestion_cache",
+            prefix="semcache:suggestions:",
+            ttl=self.suggestion_cache_ttl
+        )
+
+    async def generate_suggestions(self, query: str, answer: str, history: List[Dict[str, Any]]) -> List[str]:
+        """Generate follow-up suggestions based on the current context"""
+        redis_client = get_async_redis()
 
-            # Extract text content from response
-            response_content = response.choices[0].message.content
+        # Check cache first if caching is enabled
+        if CACHE["enable_llm_cache"]:
+            cache_key = f"suggestions:{cache_digest(query, answer)}"
+            # Entries warmed by prefetch_related live under their own prefix
+            cached, prefetched = await redis_client.mget([cache_key, f"prefetch:{cache_key}"])
+            cached_suggestions = cached or prefetched
+            if cached_suggestions:
+                try:
+                    return json.loads(cached_suggestions)
+                except json.JSONDecodeError:
+                    pass
 
-            # Parse suggestions
-            suggestions = self._parse_suggestions(response_content)
+        # Fall back to the nearest previously answered query/answer pair
+        embedding = None
+        if CACHE["enable_llm_cache"] and self.semantic_cache.enabled:
+            # The embedding call and vector search are blocking; keep them off the event loop
+            embedding = await asyncio.to_thread(self.semantic_cache.embed, f"{query}\n{answer}")
+            if embedding is not None:
+                similar_suggestions = await asyncio.to_thread(self.semantic_cache.lookup, embedding)
+                if similar_suggestions:
+                    return similar_suggestions
+
+        # Call LiteLLM directly, cheapest model first
+        try:
+            suggestions = await self._complete_with_cascade(self._build_prompt(query, answer, history))
 
             # Cache the suggestions if caching is enabled
             if CACHE["enable_llm_cache"]:
-                self.redis_client.setex(
+                await redis_client.setex(
                     cache_key,
                     self.suggestion_cache_ttl,
                     json.dumps(suggestions)
                 )
+                if embedding is not None and suggestions:
+                    await asyncio.to_thread(
+                        self.semantic_cache.store, cache_digest(query, answer), embedding, suggestions,
+                        {"query": query, "answer": answer}
+                    )
 
             return suggestions
 
-        except Exception as e:
-            print(f"Error generating suggestions: {str(e)}")
+        except Exception:
+            logger.warning("Suggestion generation failed", exc_info=True)
             return []
 
-    def _build_context(self, history: List[Dict[str, Any]]) -> str:
-        """Build context from conversation history"""
-        if not history:
-            return "No previous conversation"
+    async def prefetch_related(self, query: str, answer: str):
+        """Warm suggestions for the past exchanges most similar to this one.
+
+        Neighbours come from the semantic index; those whose suggestions are no
+        longer cached are regenerated under a prefetch: key with a shorter TTL.
+        """
+        if not (CACHE["enable_llm_cache"] and self.semantic_cache.enabled):
+            return
+
+        embedding = await asyncio.to_thread(self.semantic_cache.embed, f"{query}\n{answer}")
+        if embedding is None:
+            return
+
+        # The nearest entry is usually this exchange itself, so ask for one extra
+        neighbours = await asyncio.to_thread(self.semantic_cache.neighbours, embedding, 4, ["query", "answer"])
+        pairs = [
+            (n["query"], n["answer"]) for n in neighbours
+            if n["query"] and n["answer"] and (n["query"], n["answer"]) != (query, answer)
+        ][:3]
+        if not pairs:
+            return
+
+        cache_keys = [f"suggestions:{cache_digest(q, a)}" for q, a in pairs]
+        cached = await get_async_redis().mget(
+            [key for cache_key in cache_keys for key in (cache_key, f"prefetch:{cache_key}")]
+        )
+        await asyncio.gather(*(
+            self._prefetch_one(pairs[i], f"prefetch:{cache_keys[i]}")
+            for i in range(len(pairs)) if not (cached[2 * i] or cached[2 * i + 1])
+        ))
+
+    async def _prefetch_one(self, pair: Tuple[str, str], prefetch_key: str):
+        """Generate and store suggestions for one neighbouring exchange"""
+        async with self._prefetch_semaphore:
+            try:
+                suggestions = await self._complete_with_cascade(self._build_prompt(*pair, []))
+                if suggestions:
+                    await get_async_redis().setex(prefetch_key, CACHE["prefetch_ttl"], json.dumps(suggestions))
+            except Exception:
+                logger.warning("Suggestion prefetch failed", exc_info=True)
+
+    async def generate_suggestions_batch(self, pairs: List[Tuple[str, str]]) -> List[List[str]]:
+        """Generate follow-up suggestions for several (query, answer) pairs in one LLM call.
+
+        Pairs that are already cached are not sent again (so reloading a history
+        page costs nothing once its pairs are cached); fresh results are cached
+        under the same keys generate_suggestions uses, so later lookups are hits.
+        """
+        if not pairs:
+            return []
+
+        results: List[List[str]] = [[] for _ in pairs]
+        cache_keys = [f"suggestions:{cache_digest(query, answer)}" for query, answer in pairs]
+
+        redis_client = get_async_redis()
+        pending = list(range(len(pairs)))
+        if CACHE["enable_llm_cache"]:
+            pending = []
+            for i, cached in enumerate(await redis_client.mget(cache_keys)):
+                try:
+                    results[i] = json.loads(cached) if cached else []
+                except json.JSONDecodeError:
+                    results[i] = []
+                if not results[i]:
+                    pending.append(i)
+
+        if not pending:
+            return results
+
+        items = "\n\n".join(
+            f"Item {n}:\nQ: {pairs[i][0]}\nA: {pairs[i][1][:200]}"
+            for n, i in enumerate(pending, start=1)
+        )
+        prompt_content = (
+            f"For each of the following {len(pending)} items, output exactly 3 NPS follow-up questions. "
+            f"Start each item's questions with a line \"=== ITEM k ===\" where k is the item number.\n\n"
+            f"{items}"
+        )
+
+        def parse_batch(content: str) -> List[List[str]]:
+            # re.split yields ["preamble", "1", "chunk 1", "2", "chunk 2", ...]
+            parts = _BATCH_ITEM_RE.split(content)
+            chunks = {int(number): chunk for number, chunk in zip(parts[1::2], parts[2::2])}
+            return [self._parse_suggestions(chunks.get(n, "")) for n in range(1, len(pending) + 1)]
+
+        try:
+            batch = await self._complete_with_cascade(
+                prompt_content, parse_batch, lambda items: all(len(item) >= 3 for item in items)
+            )
 
-        context_parts = []
-        for conv in history[-3:]:  # Last 3 conversations
-            context_parts.append(f"Q: {conv['query']}\nA: {conv['answer'][:200]}...")
+            pipe = redis_client.pipeline(transaction=False)
+            for i, suggestions in zip(pending, batch):
+                results[i] = suggestions
+                if CACHE["enable_llm_cache"] and suggestions:
+                    pipe.setex(cache_keys[i], self.suggestion_cache_ttl, json.dumps(suggestions))
+            await pipe.execute()
+
+        except Exception:
+            logger.warning("Batch suggestion generation failed", exc_info=True)
+
+        return results
+
+    async def _complete_with_cascade(
+        self,
+        prompt_content: str,
+        parse: Callable[[str], T] = None,
+        accept: Callable[[T], bool] = None
+    ) -> T:
+        """Try the suggestion models in order and accept the first whose parsed reply passes accept.
+
+        By default the reply is parsed as one set of suggestions and accepted at 3
+        questions. Earlier (cheaper) models get a short timeout and their errors
+        are skipped; whatever the last model returns is used as-is.
+        """
+        parse = parse or self._parse_suggestions
+        accept = accept or (lambda parsed: len(parsed) >= 3)
+        suggestions = parse("")
+        last = len(self.models) - 1
+
+        for i, model in enumerate(self.models):
+            kwargs = {"timeout": LLM["suggestion_cascade_timeout"]} if i < last else {}
+            try:
+                response = await litellm.acompletion(
+                    model=model,
+                    messages=[self._system_messages[model], {"role": "user", "content": prompt_content}],
+                    temperature=self.temperature,
+                    **kwargs
+                )
+            except Exception:
+                suggestion_model_results.labels(model=model, outcome="error").inc()
+                if i == last:
+                    raise
+                continue
+
+            suggestions = parse(response.choices[0].message.content)
+            if accept(suggestions):
+                suggestion_model_results.labels(model=model, outcome="accepted").inc()
+                return suggestions
+            suggestion_model_results.labels(model=model, outcome="rejected").inc()
+
+        return suggestions
+
+    @staticmethod
+    def _build_system_message(model: str) -> Dict[str, Any]:
+        """System message holding the static instructions, marked cacheable for Anthropic models"""
+        if "claude" in model or model.startswith("anthropic/"):
+            return {
+                "role": "system",
+                "content": [{
+                    "type": "text",
+                    "text": SUGGESTION_SYSTEM_PROMPT,
+                    "cache_control": {"type": "ephemeral"}
+                }]
+            }
+        return {"role": "system", "content": SUGGESTION_SYSTEM_PROMPT}
+
+    def _build_prompt(self, query: str, answer: str, history: List[Dict[str, Any]]) -> str:
+        """User message for one exchange.
+
+        Only the per-request details go here; the static instructions stay a
+        byte-identical system prefix for provider prompt caching.
+        """
+        # Preview suggestions are generated before the answer exists
+        return f"""Current query: {query}
+Answer: {answer or "Not available yet"}
+Recent conversation context: {self._build_context(history)}
+
+Generate 3 follow-up NPS-related questions:"""
 
-        return "\n\n".join(context_parts)
+    def _build_context(self, history: List[Dict[str, Any]]) -> str:
+        """Build context from conversation history"""
+        # Last 3 conversations
+        return "\n\n".join(
+            f"Q: {conv['query']}\nA: {conv['answer'][:200]}..." for conv in history[-3:]
+        ) or "No previous conversation"
 
     def _parse_suggestions(self, content: str) -> List[str]:
         """Parse suggestions from LLM response"""
-        suggestions = []
-        lines = content.strip().split('\n')
-
-        for line in lines:
-            line = line.strip()
-            # Remove numbering and bullets
-            if line and any(line.startswith(prefix) for prefix in ['1.', '2.', '3.', '4.', '-', '*', '•']):
-                cleaned_line = line.lstrip('1234567890.-*• ').strip()
-                if cleaned_line and '?' in cleaned_line:
-                    suggestions.append(cleaned_line)
-            elif line and '?' in line:
-                suggestions.append(line)
-
-        return suggestions[:3]  # Return maximum 3 suggestions
\ No newline at end of file
+        return _SUGGESTION_RE.findall(content)[:3]  # Return maximum 3 suggestions
@@ -1,18 +1,95 @@
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Dict, Any, List, Optional, Tuple, Callable, Awaitable, get_args
+import asyncio
+import itertools
 import os
 import litellm
-import json
+import httpx
+import jinja2
+import orjson
 import logging
+import re
+import xxhash
 from dateutil import parser as date_parser
 from datetime import datetime, date
 from decimal import Decimal
 
-from app.config import LLM
-from app.models.visualization_models import VisualizationRecommendation, ChartConfig
+from app.config import LLM, CACHE
+from pydantic import ValidationError
+
+from app.models.visualization_models import VisualizationRecommendation, ChartConfig, LLMVizOutput, VisualizationType
+from app.services.viz_cache import MemoryTTLCache, schema_signature
 
 logger = logging.getLogger(__name__)
 
 
+def _dumps(obj: Any, indent: bool = False) -> str:
+    """orjson-encode to str; Decimal and other non-native values fall back to str()"""
+    return orjson.dumps(obj, default=str, option=orjson.OPT_INDENT_2 if indent else 0).decode()
+
+
+# Column type inference looks at the leading non-null values only: the
+# datetime check at the first few, the numeric/year check at a larger sample
+_DATETIME_SAMPLE_SIZE = 10
+_TYPE_SAMPLE_SIZE = 100
+
+# Numeric strings such as "123", "-4" or "123.45"
+_NUM_RE = re.compile(r'^-?\d+(?:\.\d+)?$')
+# ISO dates/timestamps (what SQL drivers emit), checked with datetime.fromisoformat
+_ISO_RE = re.compile(r'^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?(Z|[+-]\d{2}:?\d{2})?$')
+# Other shapes worth the slow dateutil parser: slashed dates, or a month name
+# next to a number ("12 Jan 2023", "March 5"). Bare month names ("Jan", "May")
+# stay categorical, and words like "Marketing" are never candidates.
+# Only the first few per column are actually parsed
+_MONTH = (r'(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?'
+          r'|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)')
+_FUZZY_DATE_RE = re.compile(
+    rf'/|\d[\s,-]*\b{_MONTH}\b|\b{_MONTH}\b[\s,.-]*\d', re.IGNORECASE
+)
+_DATEUTIL_SAMPLE_SIZE = 3
+
+# Fill value for cells past the end of a short row
+_MISSING = object()
+
+# Column statistics are computed over at most this many leading rows; the
+# summary still reports the true row count
+_SUMMARY_SAMPLE_ROWS = 2000
+
+# Chart types a recommendation may use
+_AVAILABLE_TYPES = frozenset(get_args(VisualizationType))
+
+# Config fields each chart type must set; each names a data column (or a list of them)
+_REQUIRED_AXES = {
+    "bar_chart": ("x_axis", "y_axis"),
+    "line_chart": ("x_axis", "y_axis"),
+    "horizontal_bar": ("x_axis", "y_axis"), # x usually categories, y values
+    "stacked_bar": ("x_axis", "y_axis"), # y_axis could be multiple series
+    "area_chart": ("x_axis", "y_axis"),
+    "scatter_plot": ("x_axis", "y_axis"),
+    "heatmap": ("x_axis", "y_axis", "value_col"),
+    "pie_chart": ("labels_col", "values_col"), # More descriptive for pie/donut
+    "donut_chart": ("labels_col", "values_col"),
+    "kpi": ("value_col",),
+}
+
+# The recommendation prompt lives in prompts/visualization_prompt.j2 and is
+# compiled once at import; each request only renders the three dynamic fields
+_PROMPT_DIR = os.path.join(os.path.dirname(__file__), "prompts")
+_jinja_env = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(_PROMPT_DIR),
+    autoescape=False,
+    auto_reload=False,
+    keep_trailing_newline=True,
+    undefined=jinja2.StrictUndefined
+)
+_VIZ_TEMPLATE = _jinja_env.get_template("visualization_prompt.j2")
+
+# Part of every recommendation cache key, derived from the template source so
+# that editing the prompt invalidates previously cached recommendations
+PROMPT_VERSION = xxhash.xxh3_64_hexdigest(
+    _jinja_env.loader.get_source(_jinja_env, "visualization_prompt.j2")[0]
+)[:12]
+
+
 class VisualizationService:
     def __init__(self):
         # Configure LiteLLM directly
@@ -23,11 +100,47 @@ class VisualizationService:
         if LLM["auth_header"]:
             litellm.headers = {"Authorization": LLM["auth_header"]}
 
+        # Shared keep-alive pool for async LiteLLM calls, so TCP+TLS setup is
+        # paid once rather than per recommendation
+        if litellm.aclient_session is None:
+            litellm.aclient_session = httpx.AsyncClient(
+                limits=httpx.Limits(max_keepalive_connections=50, max_connections=100)
+            )
+
         # Store model name and temperature for later use
         self.model = LLM["model"]
         self.temperature = LLM["summary_temperature"]
         self.llm_model = LLM["model"]
 
+        # Structured outputs constrain decoding to the LLMVizOutput schema where the
+        # provider supports them; otherwise plain JSON mode
+        try:
+            supports_schema = litellm.supports_response_schema(model=self.llm_model)
+        except Exception:
+            supports_schema = False
+        self._response_format = LLMVizOutput if supports_schema else {"type": "json_object"}
+
+        # Same question over the same result shape -> same recommendation
+        self._cache = MemoryTTLCache(maxsize=CACHE["viz_cache_size"], ttl=CACHE["viz_cache_ttl"])
+        # Recommendations currently being generated, by cache key
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Queues bursts (e.g. a dashboard refresh) instead of tripping provider rate limits
+        self._llm_sem = asyncio.Semaphore(LLM["max_concurrency"])
+
+    async def warmup(self):
+        """Issue a one-token completion so model metadata and the HTTP pool are ready before the first request"""
+        try:
+            await litellm.acompletion(
+                model=self.llm_model,
+                messages=[{"role": "user", "content": "ping"}],
+                max_tokens=1,
+                temperature=0,
+                timeout=10
+            )
+            logger.info("[VISUALIZATION SVC] LLM warmup complete.")
+        except Exception as e:
+            logger.warning(f"[VISUALIZATION SVC] LLM warmup failed: {e}")
+
     async def recommend_visualization(
         self, question: str, sql_query: str, results: Dict[str, Any]
     ) -> VisualizationRecommendation:
@@ -38,12 +151,13 @@ class VisualizationService:
             logger.info(f"[VISUALIZATION SVC] Question: {question[:200]}...") # Log first 200 chars
             logger.info(f"[VISUALIZATION SVC] SQL Query: {sql_query[:200]}...") # Log first 200 chars
             # Avoid logging full results if they are very large, log summary instead
-            results_preview = {
-                "columns": results.get("columns"),
-                "num_rows": len(results.get("rows", [])),
-                "first_row_preview": results.get("rows", [None])[0]
-            }
-            logger.info(f"[VISUALIZATION SVC] Results Preview: {json.dumps(results_preview)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                results_preview = {
+                    "columns": results.get("columns"),
+                    "num_rows": len(results.get("rows") or []),
+                    "first_row_preview": (results.get("rows") or [None])[0]
+                }
+                logger.debug("[VISUALIZATION SVC] Results Preview: %s", _dumps(results_preview))
 
             if not results or not results.get("rows"):
                 logger.warning("[VISUALIZATION SVC] No results data provided (expected 'rows' key in input), returning default table recommendation.")
@@ -59,152 +173,23 @@ class VisualizationService:
 
             # Prepare data summary for LLM
             data_summary = self._create_data_summary(results)
-            logger.info(f"[VISUALIZATION SVC] Data summary for LLM: {json.dumps(data_summary, indent=2)}")
-
-            prompt = f"""You are a data visualization expert. Based on the SQL query, the user's question, and a summary of the results, recommend the most appropriate visualization type and its configuration.
-
-User Question: {question}
-SQL Query:
-{sql_query}
-
-Data Summary:
-{json.dumps(data_summary, indent=2)}
-
-Available visualization types:
-1. table - Default for raw data, or when other charts are not suitable. Good for mixed data types or many columns.
-   - Config: {{ "title": "...", "columns_to_display": ["col1", "col2"] }} (optional, defaults to all)
-2. bar_chart - Comparing values across categories.
-   - Config: {{ "title": "...", "x_axis": "categorical_col", "y_axis": "numerical_col", "series": "optional_grouping_col" }}
-3. line_chart - Showing trends over time or continuous data.
-   - Config: {{ "title": "...", "x_axis": "time_or_continuous_col", "y_axis": "numerical_col", "series": "optional_grouping_col" }}
-4. pie_chart - Showing proportions of a whole (few categories, <=7).
-   - Config: {{ "title": "...", "labels_col": "categorical_col", "values_col": "numerical_col" }}
-5. scatter_plot - Showing relationships between two numerical variables.
-   - Config: {{ "title": "...", "x_axis": "numerical_col_1", "y_axis": "numerical_col_2", "series": "optional_grouping_col" }}
-6. area_chart - Like line chart, but emphasizes volume/magnitude.
-   - Config: {{ "title": "...", "x_axis": "time_or_continuous_col", "y_axis": "numerical_col", "series": "optional_grouping_col" }}
-7. horizontal_bar - Like bar chart, but for long category labels or many categories.
-   - Config: {{ "title": "...", "x_axis": "numerical_col", "y_axis": "categorical_col", "series": "optional_grouping_col" }}
-8. stacked_bar - Comparing parts to a whole across categories.
-    - Config: {{ "title": "...", "x_axis": "categorical_col", "y_axis": ["num_col1", "num_col2"], "series": "optional_grouping_col_for_x_axis_categories" }} or {{ "x_axis": "categorical_col", "y_axis": "numerical_col_values", "series": "categorical_col_for_stacking_segments"}}
-9. donut_chart - Similar to pie, but with center cutout (few categories, <=7).
-   - Config: {{ "title": "...", "labels_col": "categorical_col", "values_col": "numerical_col" }}
-10. heatmap - Good for showing intensity across two dimensions (e.g., categories or time). Expects config with x_axis, y_axis, and value_col for intensity.
-    - Config: {{ "title": "...", "x_axis": "col_for_x", "y_axis": "col_for_y", "value_col": "col_for_intensity_value" }}
-11. kpi - Displaying a single key metric value.
-    - Config: {{ "title": "...", "value_col": "numerical_col_with_single_value", "subtitle": "optional_description_or_comparison_metric" }}
-
-
-Consider:
--- Number and types of columns (e.g., categorical, numerical, time-series based on _infer_data_type).
--- Data patterns (trends, distributions, proportions, correlations, rankings).
--- Cardinality of categorical data: If a categorical column has many unique values (e.g., >15-20), a standard bar chart might be cluttered. Consider a horizontal bar chart for better label readability or a table view.
--- Number of data points: Pie/Donut charts are best for few categories (<=10). Line charts are good for many data points if x-axis is ordered (e.g., time).
--- Query Intent: What is the user trying to achieve? (e.g., comparison, trend, distribution). If the query is "Show me raw numbers for X", a table might be best.
--- Axes: Ensure x_axis, y_axis, labels_col, values_col, value_col are appropriate for the chart type and exist in the data_summary.columns.
--- For 'series' or grouping, it should generally be a categorical column.
--- If data has only one row and multiple columns, a table or KPI (if one primary metric) is often best. A bar chart of one bar per column might also work if all are numeric.
--- If data has many columns with diverse types, a table is usually safest.
-
-Specific Guidance:
-- Use line_chart or area_chart for time-series data showing trends (column type 'datetime' or 'year' on x-axis).
-  - **For time-series data (e.g., trends over time identified by a 'datetime', 'date', or 'year' type x-axis column), STRONGLY PREFER 'line_chart'.**
-  - The 'x_axis' should be the time-based column.
-  - For 'y_axis':
-    - If there is one primary numeric column (e.g., 'nps_score', 'sales_amount', 'count'), use that single column name.
-    - If there are multiple numeric columns and the user's question doesn't specify which one to plot, pick the most relevant or the first numeric column after the date column as the primary 'y_axis'.
-    - If appropriate, you can specify multiple numeric columns as a list for 'y_axis' (e.g., `"y_axis": ["metric1", "metric2"]`) for a multi-line chart. The frontend will attempt to plot these.
-- Use bar_chart for comparing distinct categories. If category names are long or there are many categories, prefer horizontal_bar.
-- Use pie_chart or donut_chart for showing parts of a whole (proportions) with a small number of categories (typically 3-7). If the user query explicitly asks for "distribution of [categories]", "proportion of [categories]", or "share of [categories]" and the result has one categorical column and one numerical column with few rows, STRONGLY prefer pie_chart or donut_chart.
-- Use scatter_plot for correlations between two numerical axes. If one axis is time, prefer line_chart.
-- Use heatmap when you have three dimensions: two categorical (or binnable numerical) for axes, and one numerical for intensity/color.
-- Use KPI for single, important numbers. If the result is a single row with one primary numeric value, consider KPI.
-- Default to 'table' if no other chart type is clearly superior or if the data structure is complex (e.g. many columns, mixed types, no clear patterns).
-
-**CRITICAL FOR AXES AND SERIES:**
-- When using `series` for grouping or stacking (e.g., in bar, horizontal_bar, line, area, stacked_bar charts):
-  - For `bar_chart`, `stacked_bar`, `line_chart`, `area_chart`: `x_axis` is the primary categorical grouping, `y_axis` **MUST BE A SINGLE STRING** naming the numerical value column, and `series` is the secondary categorical column for grouping/stacking within each `x_axis` category.
-  - For `horizontal_bar`: `y_axis` is the primary categorical grouping, `x_axis` **MUST BE A SINGLE STRING** naming the numerical value column, and `series` is the secondary categorical column for grouping/stacking within each `y_axis` category.
-- If you recommend a `data_transformation` to pivot data from wide to long (e.g., creating columns like 'CategoryType' and 'Value'), ensure the `x_axis`, `y_axis`, and `series` in the `config` refer to these NEWLY CREATED column names from the long format, not the original wide format columns.
-  - Example Transformation: Original wide data `(region, promoters, passives, detractors)` transformed to long data `(region, NPS_Category, count)`.
-    For a horizontal_bar showing this: `y_axis` would be "region", `x_axis` would be "count", and `series` would be "NPS_Category".
-    **DO NOT put multiple original column names (e.g., `["promoters", "passives"]`) into `x_axis` or `y_axis` in the config if you are also recommending a transformation to a long format with a series column.**
-
-Output JSON with 'visualization_type', 'config' (JS object with keys like title, x_axis, y_axis, series, labels_col, values_col, value_col), and 'reasoning' (brief explanation).
-Optionally, include 'data_transformation' object with 'required': boolean and 'instructions': [strings] if data needs minor reshaping (e.g., pivoting, aggregation hint for LLM that generates SQL next time, not for client to do). Example: {{ "required": false, "instructions": ["Consider aggregating by month for a clearer trend."] }}
-
-Example for pie chart:
-User Question: "What is the distribution of product categories?"
-Data Summary: {{ "num_rows": 3, "num_cols": 2, "columns": [{{"name": "category", "type": "categorical"}}, {{"name": "count", "type": "numeric"}}] }}
-Output:
-{{
-    "visualization_type": "pie_chart",
-    "config": {{
-        "title": "Distribution of Product Categories",
-        "labels_col": "category",
-        "values_col": "count"
-    }},
-    "reasoning": "Pie chart is suitable for showing proportions of a few categories.",
-    "data_transformation": null
-}}
-
-Example for bar chart:
-User Question: "Sales per region"
-Data Summary: {{ "num_rows": 5, "num_cols": 2, "columns": [{{"name": "region", "type": "categorical"}}, {{"name": "total_sales", "type": "numeric"}}] }}
-Output:
-{{
-    "visualization_type": "bar_chart",
-    "config": {{
-        "title": "Sales per Region",
-        "x_axis": "region",
-        "y_axis": "total_sales"
-    }},
-    "reasoning": "Bar chart for comparing sales across different regions.",
-    "data_transformation": null
-}}
-
-Ensure that all column names used in the 'config' (e.g., for x_axis, y_axis, series, labels_col, values_col, value_col) EXACTLY MATCH the column names provided in the Data Summary. Be very careful with this.
-If data_summary shows num_rows: 0, always recommend 'table' with a message.
-If the user asks for "raw data" or "show table", always recommend 'table'.
-Provide your response as a single, valid JSON object.
-"""
-            # logger.debug(f"Prompt for LLM: {prompt}")
-            response = await litellm.acompletion(
-                model=self.llm_model,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.1, # Low temperature for more deterministic recommendations
-                response_format={"type": "json_object"}
-            )
-            response_content = response.choices[0].message.content
-            logger.info(f"[VISUALIZATION SVC] Raw LLM response for visualization: {response_content[:1000]}...") # Log more chars
 
-            try:
-                visualization_config_dict = json.loads(response_content)
-                logger.info(f"[VISUALIZATION SVC] Parsed LLM response: {json.dumps(visualization_config_dict, indent=2)}")
-
-                is_valid, error_msg = self._validate_recommendation(visualization_config_dict, data_summary)
-                if not is_valid:
-                    logger.error(f"[VISUALIZATION SVC] LLM recommendation failed validation: {error_msg}. LLM Output: {response_content}")
-                    # Fallback to table with the error message as reasoning or part of title
-                    fallback_reason = f"Invalid recommendation from LLM: {error_msg}. Defaulting to table."
-                    chart_config = ChartConfig(title=f"Data (Recommendation Error)", x_axis=data_summary["columns"][0]["name"] if data_summary["columns"] else None)
-                    vis_rec = VisualizationRecommendation(visualization_type="table", config=chart_config, reasoning=fallback_reason, data_transformation=None)
-                else:
-                    logger.info("[VISUALIZATION SVC] LLM recommendation PASSED validation.")
-                    chart_config = ChartConfig(**visualization_config_dict.get("config", {}))
-                    vis_rec = VisualizationRecommendation(
-                        visualization_type=visualization_config_dict["visualization_type"],
-                        config=chart_config,
-                        reasoning=visualization_config_dict.get("reasoning", ""),
-                        data_transformation=visualization_config_dict.get("data_transformation")
-                    )
-
-            except json.JSONDecodeError as e:
-                logger.error(f"[VISUALIZATION SVC] Failed to parse LLM JSON response for visualization: {e}. Response: {response_content}", exc_info=True)
-                chart_config = ChartConfig(title="Data (JSON Error)", x_axis=data_summary["columns"][0]["name"] if data_summary["columns"] else None)
-                vis_rec = VisualizationRecommendation(visualization_type="table", config=chart_config, reasoning=f"Error parsing LLM response: {e}", data_transformation=None)
-            
-            return vis_rec
+            # Shapes the prompt itself would answer with a table or KPI skip the LLM
+            deterministic_rec = self._deterministic_recommendation(question, data_summary)
+            if deterministic_rec is not None:
+                logger.info(f"[VISUALIZATION SVC] Deterministic {deterministic_rec.visualization_type} recommendation, LLM skipped.")
+                return deterministic_rec
+
+            cache_key = self._cache_key(question, data_summary)
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                logger.info("[VISUALIZATION SVC] Serving cached recommendation.")
+                return VisualizationRecommendation.model_validate(cached)
+
+            return await self._single_flight(
+                cache_key,
+                lambda: self._recommend_with_llm(question, sql_query, data_summary, cache_key)
+            )
 
         except Exception as e:
             logger.error(f"[VISUALIZATION SVC] Error in recommend_visualization: {e}", exc_info=True)
@@ -219,6 +204,156 @@ Provide your response as a single, valid JSON object.
                 data_transformation=None
             )
 
+    async def recommend_visualizations_batch(
+        self, requests: List[Tuple[str, str, Dict[str, Any]]], max_concurrency: Optional[int] = None
+    ) -> List[VisualizationRecommendation]:
+        """Recommend visualizations for several (question, sql_query, results) items concurrently.
+
+        Items share the cache and in-flight coalescing of recommend_visualization;
+        at most max_concurrency of them run at once. Results keep the input order.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency or LLM["visualization_batch_concurrency"])
+
+        async def recommend(question: str, sql_query: str, results: Dict[str, Any]) -> VisualizationRecommendation:
+            async with semaphore:
+                return await self.recommend_visualization(question, sql_query, results)
+
+        return list(await asyncio.gather(*(recommend(*item) for item in requests)))
+
+    async def _single_flight(
+        self, key: str, make_call: Callable[[], Awaitable[VisualizationRecommendation]]
+    ) -> VisualizationRecommendation:
+        """Run make_call once per key at a time; concurrent callers await the same result"""
+        # No await between the lookup and the insert, so this is race-free on the event loop
+        future = self._inflight.get(key)
+        if future is not None:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # This caller was cancelled
+                # The leader was cancelled (e.g. its client disconnected), not this
+                # caller: take over the call, coalescing with any other followers
+                return await self._single_flight(key, make_call)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await make_call()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark retrieved so a follower-less failure is not reported again
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _recommend_with_llm(
+        self, question: str, sql_query: str, data_summary: Dict[str, Any], cache_key: str
+    ) -> VisualizationRecommendation:
+        """Ask the LLM for a recommendation and validate it, falling back to a table"""
+        # Serialized once, for the prompt (and the debug log when enabled)
+        data_summary_json = _dumps(data_summary, indent=True)
+        logger.debug("[VISUALIZATION SVC] Data summary for LLM: %s", data_summary_json)
+
+        prompt = _VIZ_TEMPLATE.render(question=question, sql_query=sql_query, data_summary_json=data_summary_json)
+        # logger.debug(f"Prompt for LLM: {prompt}")
+        async with self._llm_sem:
+            response = await litellm.acompletion(
+                model=self.llm_model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.1, # Low temperature for more deterministic recommendations
+                max_tokens=LLM["visualization_max_tokens"], # Bounds decode time on the critical path
+                response_format=self._response_format
+            )
+        response_content = response.choices[0].message.content
+        logger.debug("[VISUALIZATION SVC] Raw LLM response for visualization: %.1000s...", response_content)
+
+        # Trim anything around the outermost object (code fences, trailing
+        # whitespace or chatter) so minor formatting drift does not force the fallback
+        start = response_content.find('{')
+        end = response_content.rfind('}')
+        payload = response_content[start:end + 1] if start >= 0 and end > start else response_content
+
+        try:
+            # Parses and validates in one step (pydantic's JSON parser)
+            visualization_config_dict = LLMVizOutput.model_validate_json(payload).model_dump()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[VISUALIZATION SVC] Parsed LLM response: %s", _dumps(visualization_config_dict, indent=True))
+
+            is_valid, error_msg = self._validate_recommendation(visualization_config_dict, data_summary)
+            if not is_valid:
+                logger.error(f"[VISUALIZATION SVC] LLM recommendation failed validation: {error_msg}. LLM Output: {response_content}")
+                # Fallback to table with the error message as reasoning or part of title
+                fallback_reason = f"Invalid recommendation from LLM: {error_msg}. Defaulting to table."
+                chart_config = ChartConfig(title=f"Data (Recommendation Error)", x_axis=data_summary["columns"][0]["name"] if data_summary["columns"] else None)
+                vis_rec = VisualizationRecommendation(visualization_type="table", config=chart_config, reasoning=fallback_reason, data_transformation=None)
+            else:
+                logger.info("[VISUALIZATION SVC] LLM recommendation PASSED validation.")
+                chart_config = ChartConfig(**visualization_config_dict.get("config", {}))
+                vis_rec = VisualizationRecommendation(
+                    visualization_type=visualization_config_dict["visualization_type"],
+                    config=chart_config,
+                    reasoning=visualization_config_dict.get("reasoning", ""),
+                    data_transformation=visualization_config_dict.get("data_transformation")
+                )
+                # Only validated LLM output is cached, never a fallback
+                self._cache.set(cache_key, vis_rec.model_dump())
+
+        except ValidationError as e:
+            logger.error(f"[VISUALIZATION SVC] Failed to parse LLM JSON response for visualization: {e}. Response: {response_content}", exc_info=True)
+            chart_config = ChartConfig(title="Data (JSON Error)", x_axis=data_summary["columns"][0]["name"] if data_summary["columns"] else None)
+            vis_rec = VisualizationRecommendation(visualization_type="table", config=chart_config, reasoning=f"Error parsing LLM response: {e}", data_transformation=None)
+
+        return vis_rec
+
+    def _deterministic_recommendation(
+        self, question: str, data_summary: Dict[str, Any]
+    ) -> Optional[VisualizationRecommendation]:
+        """Recommendation for result shapes with only one sensible answer, or None to ask the LLM"""
+        columns = data_summary.get("columns", [])
+        row_count = data_summary.get("row_count", 0)
+        column_count = data_summary.get("column_count", len(columns))
+        first_col = columns[0]["name"] if columns else None
+
+        # No rows, or too many columns for any chart type to stay readable
+        if row_count == 0 or column_count > 15:
+            return VisualizationRecommendation(
+                visualization_type="table",
+                config=ChartConfig(title=question or "Query Results", x_axis=first_col),
+                reasoning="Deterministic fallback: structure unsuitable for chart types.",
+                data_transformation=None
+            )
+
+        # A single wide record reads best as a table
+        if row_count == 1 and column_count > 8:
+            return VisualizationRecommendation(
+                visualization_type="table",
+                config=ChartConfig(title=question or "Query Results", x_axis=first_col),
+                reasoning="Deterministic fallback: single record with many fields.",
+                data_transformation=None
+            )
+
+        # A single numeric value is a KPI
+        if row_count == 1 and column_count == 1 and columns[0]["data_type"] in {"integer", "float", "numeric"}:
+            return VisualizationRecommendation(
+                visualization_type="kpi",
+                config=ChartConfig(title=question or first_col, value_col=first_col),
+                reasoning="Deterministic: single numeric value.",
+                data_transformation=None
+            )
+
+        return None
+
+    def _cache_key(self, question: str, data_summary: Dict[str, Any]) -> str:
+        """Recommendation cache key: prompt version, model, question and result shape"""
+        question_digest = xxhash.xxh3_64_hexdigest(question or "")
+        return f"viz:v1:{PROMPT_VERSION}:{self.llm_model}:{question_digest}:{schema_signature(data_summary)}"
+
     def _create_data_summary(self, results: Dict[str, Any]) -> Dict[str, Any]:
         """Create a summary of the result data for LLM analysis"""
         # The 'results' object here is expected to be the tableData structure: {"columns": [], "rows": []}
@@ -234,79 +369,134 @@ Provide your response as a single, valid JSON object.
             return {"error": "No columns or rows found in the provided results."}
 
 
+        sample = data[:_SUMMARY_SAMPLE_ROWS]
         summary = {
             "column_count": len(columns),
             "row_count": len(data),
+            "sampled_rows": len(sample),
             "columns": []
         }
 
+        # Transpose once instead of re-scanning every row for each column; short
+        # rows are padded with a sentinel (not None, which would count as a null)
+        # so they neither truncate other columns nor feed the column stats
+        cols_data = list(itertools.zip_longest(
+            *(row for row in sample if isinstance(row, (list, tuple))), fillvalue=_MISSING
+        ))
+
         for i, col_name in enumerate(columns): # MODIFIED: Iterate by col_name from columns list
-            # Ensure row has enough elements before trying to access by index i
-            col_data = [row[i] for row in data if isinstance(row, (list, tuple)) and i < len(row)]
-            
+            col_data = cols_data[i] if i < len(cols_data) else ()
+
+            # Single pass over the column for nulls, distinct values, samples and numeric stats
+            null_count = 0
+            unique_values = set()
+            sample_values = []  # First 5 distinct values, in row order
+            num_min = num_max = None
+            num_sum = 0.0
+            num_count = 0
+            n_typed = n_numeric = n_datetime = n_year = 0
+            n_dateutil = n_dateutil_ok = 0
+            for value in col_data:
+                if value is _MISSING:
+                    continue
+                if value is None:
+                    null_count += 1
+                    continue
+                # SQL cell values are hashable; str() only for the odd one that is not
+                try:
+                    unique_values.add(value)
+                except TypeError:
+                    unique_values.add(str(value))
+                if len(sample_values) < 5:
+                    value_str = str(value)
+                    if value_str not in sample_values:
+                        sample_values.append(value_str)
+
+                # Tally the leading non-null values for type inference
+                if n_typed < _TYPE_SAMPLE_SIZE:
+                    if n_typed < _DATETIME_SAMPLE_SIZE:
+                        if self._is_iso_datetime(value):
+                            n_datetime += 1
+                        elif isinstance(value, str) and _FUZZY_DATE_RE.search(value):
+                            if n_dateutil < _DATEUTIL_SAMPLE_SIZE:
+                                n_dateutil += 1
+                                parsed = self._parses_as_date(value)
+                                n_dateutil_ok += parsed
+                            else:
+                                # Past the parse budget, follow the verdict of the parsed ones
+                                parsed = n_dateutil_ok == n_dateutil
+                            if parsed:
+                                n_datetime += 1
+                    if isinstance(value, (int, float, Decimal)):
+                        n_numeric += 1
+                        # Heuristic for Year (e.g., 2023, 2024)
+                        if isinstance(value, int) and 1900 <= value <= 2100:
+                            n_year += 1
+                    elif isinstance(value, str) and _NUM_RE.match(value):
+                        n_numeric += 1
+                        if value.isdigit() and 1900 <= int(value) <= 2100: # String year check
+                            n_year += 1
+                    n_typed += 1
+
+                # Running numeric stats (Decimal is what drivers return for NUMERIC columns)
+                if isinstance(value, (int, float, Decimal)):
+                    num_min = value if num_min is None or value < num_min else num_min
+                    num_max = value if num_max is None or value > num_max else num_max
+                    num_sum += float(value)
+                    num_count += 1
+
             col_summary = {
                 "name": col_name, # MODIFIED: Use col_name directly
-                "data_type": self._infer_data_type(col_data),
-                "unique_values": len(set(str(x) for x in col_data if x is not None)),
-                "null_count": sum(1 for x in col_data if x is None),
-                "sample_values": list(set(str(x) for x in col_data[:5] if x is not None))
+                "data_type": self._infer_data_type_from_stats(n_typed, n_numeric, n_datetime, n_year),
+                "unique_values_in_sample": len(unique_values),
+                "null_count": null_count,
+                "sample_values": sample_values
             }
 
-            # Add numeric statistics if applicable
-            if col_summary["data_type"] in ["integer", "float"]:
-                numeric_values = [x for x in col_data if isinstance(x, (int, float))]
-                if numeric_values:
-                    col_summary["min"] = min(numeric_values)
-                    col_summary["max"] = max(numeric_values)
-                    col_summary["avg"] = sum(numeric_values) / len(numeric_values)
+            # Add numeric statistics if applicable ("numeric" is what type inference reports)
+            if col_summary["data_type"] in ("integer", "float", "numeric") and num_count:
+                col_summary["min"] = num_min
+                col_summary["max"] = num_max
+                col_summary["avg"] = num_sum / num_count
 
             summary["columns"].append(col_summary)
 
         return summary
 
-    def _infer_data_type(self, values: List[Any]) -> str:
-        """Infer the data type of a column from its values"""
-        non_null_values = [v for v in values if v is not None]
-        if not non_null_values:
+    @staticmethod
+    def _is_iso_datetime(value: Any) -> bool:
+        """Whether a cell is a date/datetime object or an ISO-formatted string"""
+        if isinstance(value, (datetime, date)):
+            return True
+        if isinstance(value, str) and _ISO_RE.match(value):
+            try:
+                datetime.fromisoformat(value.replace('Z', '+00:00'))
+                return True
+            except ValueError:
+                pass
+        return False
+
+    @staticmethod
+    def _parses_as_date(value: str) -> bool:
+        """Slow path for non-ISO date strings"""
+        try:
+            date_parser.parse(value)
+            return True
+        except (ValueError, TypeError, OverflowError):
+            return False
+
+    def _infer_data_type_from_stats(self, n_nonnull: int, n_numeric: int, n_datetime_hits: int, n_year_like: int) -> str:
+        """Infer a column's data type from value tallies over its leading non-null values"""
+        if not n_nonnull:
             return "unknown"
 
-        # Attempt to parse as datetime first
-        datetime_count = 0
-        for v in non_null_values[:10]: # Sample first 10 non-null values
-            if isinstance(v, (datetime, date)):
-                datetime_count += 1
-                continue
-            if isinstance(v, str):
-                try:
-                    date_parser.parse(v)
-                    # Heuristic: if parsing succeeded and original string contains typical date separators or time patterns
-                    if any(sep in v for sep in ['-', '/', ':']) or ('AM' in v.upper() or 'PM' in v.upper()):
-                        datetime_count += 1
-                except (ValueError, TypeError, OverflowError):
-                    pass
-        if datetime_count > 5: # If more than half of the sample parsed as datetime
+        if n_datetime_hits > 5: # If more than half of the datetime sample parsed as datetime
             return "datetime"
 
-        # Check for numeric types (integer or float)
-        numeric_count = 0
-        potential_year_count = 0
-        for v in non_null_values:
-            if isinstance(v, (int, float, Decimal)):
-                numeric_count += 1
-                # Heuristic for Year (e.g., 2023, 2024) - avoid treating as general numeric if it looks like a year
-                if isinstance(v, int) and 1900 <= v <= 2100:
-                    potential_year_count +=1
-            elif isinstance(v, str) and v.replace('.', '', 1).isdigit(): # handles "123", "123.45"
-                 numeric_count += 1
-                 if v.isdigit() and 1900 <= int(v) <= 2100: # String year check
-                     potential_year_count +=1
-
-
-        if numeric_count == len(non_null_values):
-            # If all numeric values look like years, and the column name hints at it, prefer 'year' or 'categorical'
-            # For now, let's lean towards numeric if all are numeric, refinement can be done in _create_data_summary
-            if potential_year_count == len(non_null_values):
-                 return "year" # or "categorical" if context suggests, but "year" is more specific
+        if n_numeric == n_nonnull:
+            # All-year columns are reported as 'year' rather than general numeric
+            if n_year_like == n_nonnull:
+                return "year"
             return "numeric"
 
         # Default to categorical
@@ -316,17 +506,13 @@ Provide your response as a single, valid JSON object.
         viz_type = recommendation.get("visualization_type")
         config = recommendation.get("config", {})
         
-        logger.debug(f"[VISUALIZATION VALIDATION] Validating: {recommendation} against summary: {data_summary}")
+        logger.debug("[VISUALIZATION VALIDATION] Validating: %s against summary: %s", recommendation, data_summary)
 
         if not viz_type:
             return False, "Missing 'visualization_type'."
 
-        available_types = [
-            "bar_chart", "line_chart", "pie_chart", "scatter_plot", "table", 
-            "area_chart", "horizontal_bar", "stacked_bar", "donut_chart", "heatmap", "kpi"
-        ]
-        if viz_type not in available_types:
-            return False, f"Invalid 'visualization_type': {viz_type}. Must be one of {available_types}."
+        if viz_type not in _AVAILABLE_TYPES:
+            return False, f"Invalid 'visualization_type': {viz_type}. Must be one of {sorted(_AVAILABLE_TYPES)}."
 
         if not isinstance(config, dict):
             return False, "'config' must be a dictionary."
@@ -336,65 +522,46 @@ Provide your response as a single, valid JSON object.
             # Not a critical error, can be defaulted on frontend.
 
         column_names = [col["name"] for col in data_summary.get("columns", [])]
+        column_set = frozenset(column_names)
+
+        # If a data transformation is required, skip strict column validation for axes/series,
+        # as they might refer to columns created by the transformation.
+        data_transformation_field = recommendation.get("data_transformation")
+        data_transformation_required = isinstance(data_transformation_field, dict) and bool(data_transformation_field.get("required"))
+
+        for axis in _REQUIRED_AXES.get(viz_type, ()):
+            axis_val = config.get(axis)
+            if not axis_val:
+                # For stacked_bar, y_axis might be omitted when the series are given as a list.
+                if viz_type == "stacked_bar" and axis == "y_axis" and isinstance(config.get("series"), list) and config.get("series"):
+                    continue
+                return False, f"Missing '{axis}' in config for {viz_type}."
+            if not data_transformation_required:
+                error = self._check_columns(axis, axis_val, column_set, column_names)
+                if error:
+                    return False, error
 
-        required_axes = {
-            "bar_chart": ["x_axis", "y_axis"],
-            "line_chart": ["x_axis", "y_axis"],
-            "horizontal_bar": ["x_axis", "y_axis"], # x usually categories, y values
-            "stacked_bar": ["x_axis", "y_axis"], # y_axis could be multiple series
-            "area_chart": ["x_axis", "y_axis"],
-            "scatter_plot": ["x_axis", "y_axis"],
-            "heatmap": ["x_axis", "y_axis", "value_col"],
-            "pie_chart": ["labels_col", "values_col"], # More descriptive for pie/donut
-            "donut_chart": ["labels_col", "values_col"]
-        }
-        
-        if viz_type in required_axes:
-            for axis in required_axes[viz_type]:
-                axis_val = config.get(axis)
-                if not axis_val:
-                    # For stacked_bar, y_axis might be a list of columns.
-                    if viz_type == "stacked_bar" and axis == "y_axis" and isinstance(config.get("series"), list) and config.get("series"):
-                        continue # y_axis itself isn't specified but series are, which is fine.
-
-                    return False, f"Missing '{axis}' in config for {viz_type}."
-                
-                # If a data transformation is required, skip strict column validation for axes/series involved in transformation,
-                # as they might refer to columns created by the transformation.
-                data_transformation_field = recommendation.get("data_transformation")
-                data_transformation_required = isinstance(data_transformation_field, dict) and data_transformation_field.get("required", False)
-
-                # If axis_val is a single column string
-                if isinstance(axis_val, str) and not data_transformation_required and axis_val not in column_names:
-                    return False, f"Column '{axis_val}' specified for '{axis}' not found in data columns: {column_names}."
-                # If axis_val is a list (e.g. for y_axis in stacked_bar if LLM returns list for y_axis directly)
-                elif isinstance(axis_val, list) and not data_transformation_required:
-                    for col in axis_val:
-                        if col not in column_names:
-                             return False, f"Column '{col}' in '{axis}' list not found in data columns: {column_names}."
-        
         # Validate series column if present
         series_col = config.get("series")
-        data_transformation_field = recommendation.get("data_transformation") # Check again for series context
-        data_transformation_required = isinstance(data_transformation_field, dict) and data_transformation_field.get("required", False)
-
-        if series_col and not data_transformation_required: # Only validate if no transformation is pending that might create this column
-            if isinstance(series_col, str) and series_col not in column_names:
-                return False, f"Column '{series_col}' specified for 'series' not found in data columns: {column_names}."
-            elif isinstance(series_col, list): # For multi-series charts like stacked_bar
-                for col in series_col:
-                    if col not in column_names:
-                        return False, f"Column '{col}' in 'series' list not found in data columns: {column_names}."
-
-        # Specific check for KPI
-        if viz_type == "kpi":
-            if not config.get("value_col"):
-                return False, "Missing 'value_col' in config for kpi."
-            if config.get("value_col") not in column_names:
-                 return False, f"Column '{config.get('value_col')}' specified for 'value_col' in KPI not found in data columns: {column_names}."
+        if series_col and not data_transformation_required:
+            error = self._check_columns("series", series_col, column_set, column_names)
+            if error:
+                return False, error
 
         return True, None
 
+    @staticmethod
+    def _check_columns(field: str, value: Any, column_set: frozenset, column_names: List[str]) -> Optional[str]:
+        """Error message if a config field names a column (or list of columns) not in the data"""
+        if isinstance(value, str):
+            if value not in column_set:
+                return f"Column '{value}' specified for '{field}' not found in data columns: {column_names}."
+        elif isinstance(value, list):
+            for col in value:
+                if col not in column_set:
+                    return f"Column '{col}' in '{field}' list not found in data columns: {column_names}."
+        return None
+
     def _suggest_data_transformation(self, config: Dict[str, Any], results: Dict[str, Any]) -> Dict[str, Any]:
         """Suggest data transformations needed for visualization"""
         viz_type = config.get("visualization_type")
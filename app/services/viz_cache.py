@@ -0,0 +1,53 @@
+import random
+import threading
+from typing import Any, Dict, Hashable, Optional
+
+import orjson
+import xxhash
+from cachetools import TLRUCache
+from prometheus_client import Counter
+
+# Metrics
+viz_cache_requests = Counter(
+    'viz_cache_requests_total', 'Visualization recommendation cache lookups', ['outcome']
+)
+
+
+class MemoryTTLCache:
+    """Thread-safe in-process LRU cache whose entries expire after a jittered TTL"""
+
+    def __init__(self, maxsize: int, ttl: float, jitter: float = 0.1):
+        self.ttl = ttl
+        self.jitter = jitter
+        self._cache = TLRUCache(maxsize=maxsize, ttu=self._expires_at)
+        self._lock = threading.RLock()
+
+    def _expires_at(self, _key: Hashable, _value: Any, now: float) -> float:
+        # Spread expiries so entries cached in the same burst do not all miss together
+        return now + self.ttl * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value, or None when missing or expired"""
+        with self._lock:
+            value = self._cache.get(key)
+        viz_cache_requests.labels(outcome="miss" if value is None else "hit").inc()
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        """Store a value, evicting the least recently used entry when full"""
+        with self._lock:
+            self._cache[key] = value
+
+    def clear(self):
+        """Drop every entry"""
+        with self._lock:
+            self._cache.clear()
+
+
+def schema_signature(data_summary: Dict[str, Any]) -> str:
+    """Digest of a result's shape: column names, inferred types and a row-count bucket"""
+    shape = {
+        "cols": [(col["name"], col["data_type"]) for col in data_summary.get("columns", [])],
+        "rows_bucket": min(data_summary.get("row_count", 0), 10_000) // 10
+    }
+    return xxhash.xxh3_64_hexdigest(orjson.dumps(shape, default=str, option=orjson.OPT_SORT_KEYS))
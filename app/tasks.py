@@ -1,18 +1,31 @@
-from celery import Celery, Task
-from datetime import datetime, date
+from celery import Celery, Task, group
+from celery.result import GroupResult
+from celery.signals import worker_process_init, worker_process_shutdown
+from datetime import datetime, timezone
 import os
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 import redis
-import json
+import orjson
+import xxhash
+import zstandard
+import msgspec
+import asyncio
 import logging
 import time
-from decimal import Decimal
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+from kombu import Exchange, Queue
+from kombu.serialization import register
 from prometheus_client import Counter, Histogram
-from .agents.sql_agent import SQLAgent, DatabaseConnectionError, AIServiceError
+from .agents.sql_agent import SQLAgent, DatabaseConnectionError, AIServiceError, json_serialize
 from .graphs.correction_graph import create_correction_graph
+from .services.redis_pool import get_redis, close_async_redis
+from .services.memory_service import MemoryService, query_cache_key, fetch_cached_query
+from .services.suggestion_service import SuggestionService
 
 # Import config
-from app.config import CELERY, REDIS, CACHE
+from app.config import CELERY, CACHE
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -21,6 +34,23 @@ logger = logging.getLogger(__name__)
 task_counter = Counter('celery_tasks_total', 'Total Celery tasks', ['task_name', 'status'])
 task_duration = Histogram('celery_task_duration_seconds', 'Celery task duration', ['task_name'])
 
+# Label children bound once, rather than resolved on every observation
+_process_query_timer = task_duration.labels(task_name="process_query_task")
+_suggestions_timer = task_duration.labels(task_name="generate_suggestions_task")
+_suggestions_preview_timer = task_duration.labels(task_name="generate_suggestions_preview_task")
+_cache_schema_timer = task_duration.labels(task_name="cache_schema_task")
+_cleanup_sessions_timer = task_duration.labels(task_name="cleanup_sessions_task")
+_task_status_counters = {
+    name: {
+        status: task_counter.labels(task_name=name, status=status)
+        for status in ('success', 'failed', 'retry', 'cache_hit')
+    }
+    for name in (
+        'process_query_task', 'generate_suggestions_task', 'generate_suggestions_preview_task',
+        'cache_schema_task', 'cleanup_sessions_task', 'health_check_task'
+    )
+}
+
 # Initialize Celery
 celery_app = Celery(
     "sql_chat_agent",
@@ -30,9 +60,9 @@ celery_app = Celery(
 
 # Configure Celery
 celery_app.conf.update(
-    task_serializer='json',
-    accept_content=['json'],
-    result_serializer='json',
+    task_serializer='msgpack',
+    accept_content=['msgpack', 'orjson', 'json'],  # json is still accepted while old producers drain
+    result_serializer='msgpack',
     timezone='UTC',
     enable_utc=True,
     task_track_started=True,
@@ -43,30 +73,149 @@ celery_app.conf.update(
     task_acks_late=True,
     worker_max_memory_per_child=CELERY["worker_max_memory_per_child"],
     broker_connection_retry_on_startup=True,
+    # Each workload gets its own queue and worker group (see docker-compose),
+    # so long LLM/SQL work cannot starve maintenance or health checks.
+    # Maintenance and health messages are cheap to lose, so skip broker persistence
+    task_queues=(
+        Queue('llm', Exchange('llm'), routing_key='llm'),
+        Queue('maintenance', Exchange('maintenance', delivery_mode=1), routing_key='maintenance', durable=False),
+        Queue('health', Exchange('health', delivery_mode=1), routing_key='health', durable=False),
+    ),
+    task_default_queue='llm',
+    task_routes={
+        'process_query_task': {'queue': 'llm'},
+        'generate_suggestions_task': {'queue': 'llm'},
+        'generate_suggestions_preview_task': {'queue': 'llm'},
+        'cache_schema_task': {'queue': 'maintenance'},
+        'cleanup_sessions_task': {'queue': 'maintenance'},
+        'health_check_task': {'queue': 'health'},
+    },
+)
+
+# Options for cached payloads; naive datetimes from the database are UTC
+_ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY
+
+# Cached results at or above this size are stored zstd-compressed; readers
+# recognise the frame magic, so small payloads stay plain JSON
+_COMPRESS_MIN_BYTES = 1024
+_zstd_compressor = zstandard.ZstdCompressor(level=3)
+
+# Celery message codec; msgspec encodes datetime and Decimal natively
+_msgpack_encoder = msgspec.msgpack.Encoder(enc_hook=json_serialize)
+_msgpack_decoder = msgspec.msgpack.Decoder()
+
+register(
+    'msgpack',
+    _msgpack_encoder.encode,
+    _msgpack_decoder.decode,
+    content_type='application/x-msgpack',
+    content_encoding='binary'
 )
 
-# Define the json_serialize function at the top of tasks.py as well
-def json_serialize(obj):
-    """JSON serializer for objects not serializable by default json code"""
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    if isinstance(obj, Decimal):
-        return str(obj)
-    raise TypeError(f"Type {type(obj)} not serializable")
+# JSON messages still in flight (or from producers on the old config) decode
+# through orjson too: registering for application/json replaces kombu's
+# stdlib json decoder for that content type
+register(
+    'orjson',
+    lambda obj: orjson.dumps(obj, default=json_serialize, option=_ORJSON_OPTIONS),
+    orjson.loads,
+    content_type='application/json',
+    content_encoding='utf-8'
+)
+
+# Per-process Redis client on the shared pool, reused across tasks
+_redis: Optional[redis.Redis] = None
+
+# Per-process SQL agent (engine, LLM config), built once and reused until the
+# child is recycled by worker_max_tasks_per_child
+_sql_agent: Optional[SQLAgent] = None
+
+# Digest of the last schema this process wrote, to skip rewriting an unchanged one
+_last_schema_hash: Optional[int] = None
+
+
+@worker_process_init.connect
+def _init_worker_process(**_kwargs):
+    """Build per-process clients after fork, so prefork children never share sockets"""
+    global _redis, _sql_agent
+    _redis = get_redis(decode_responses=False)
+    try:
+        _sql_agent = SQLAgent()
+    except Exception as e:
+        # Leave it to the first task, which retries on connection errors
+        logger.warning(f"Failed to initialize SQL agent at worker start: {str(e)}")
+
+
+def _redis_client() -> redis.Redis:
+    """Return the worker's Redis client, creating it for pools that never fork"""
+    global _redis
+    if _redis is None:
+        _redis = get_redis(decode_responses=False)
+    return _redis
+
+
+def _get_sql_agent() -> SQLAgent:
+    """Return the worker's SQL agent, creating it on first use"""
+    global _sql_agent
+    if _sql_agent is None:
+        _sql_agent = SQLAgent()
+    return _sql_agent
+
+
+@lru_cache(maxsize=1)
+def _get_correction_graph():
+    """Return the worker's correction graph, compiling it on first use.
+
+    Safe to share: the graph is compiled without a checkpointer, so all
+    per-query state lives in the dict passed to invoke().
+    """
+    return create_correction_graph()
+
+# Hot results kept in-process to skip even the Redis round-trip. Keys carry
+# the conversation digest from query_cache_key, so a follow-up is only served
+# to a session in the same conversation state
+_local_results = TTLCache(maxsize=512, ttl=min(60, CACHE["query_cache_ttl"]))
+
+def _run_async(coro):
+    """asyncio.run() for task bodies; the loop's Redis pools are closed before it ends"""
+    async def runner():
+        try:
+            return await coro
+        finally:
+            await close_async_redis()
+    return asyncio.run(runner())
+
+# Background writer for result caching, off the task's critical path
+_cache_writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="query-cache")
+
+
+def _write_query_cache(cache_key: str, payload: bytes):
+    """Store an encoded query result under its content-addressed key"""
+    try:
+        _redis_client().setex(cache_key, CACHE["query_cache_ttl"], payload)
+        logger.info(f"Successfully cached query result")
+    except Exception as e:
+        logger.warning(f"Failed to cache query result: {str(e)}")
+
+
+@worker_process_shutdown.connect
+def _flush_cache_writer(**_kwargs):
+    """Finish queued cache writes before a recycled child exits"""
+    _cache_writer.shutdown(wait=True)
 
 class LogErrorsTask(Task):
     """Custom task class that logs errors"""
 
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         logger.error(f"Task {self.name} [{task_id}] failed: {exc}", exc_info=True)
-        task_counter.labels(task_name=self.name, status='failed').inc()
+        _task_status_counters[self.name]['failed'].inc()
 
     def on_success(self, retval, task_id, args, kwargs):
-        task_counter.labels(task_name=self.name, status='success').inc()
+        _task_status_counters[self.name]['success'].inc()
 
     def on_retry(self, exc, task_id, args, kwargs, einfo):
         logger.warning(f"Task {self.name} [{task_id}] retrying: {exc}")
-        task_counter.labels(task_name=self.name, status='retry').inc()
+        _task_status_counters[self.name]['retry'].inc()
 
 
 @celery_app.task(
@@ -78,15 +227,25 @@ class LogErrorsTask(Task):
 )
 def process_query_task(self, query: str, session_id: str, history: List[Dict[str, Any]]) -> Dict[str, Any]:
     """Process a natural language query asynchronously with comprehensive error handling"""
-    start_time = time.time()
+    start_time = time.perf_counter()
+    cache_key = query_cache_key(query, history)
+
+    # Repeat query in the same conversation state: answer from cache without
+    # touching the LLM or database
+    if CACHE["enable_llm_cache"]:
+        cached = fetch_cached_query(_redis_client(), cache_key, _local_results)
+        # Entries written before failures stopped being cached may still hold one
+        if cached is not None and cached.get("success"):
+            logger.info(f"Cache hit for query in session {session_id}")
+            _task_status_counters['process_query_task']['cache_hit'].inc()
+            # Report this request's time, not the one that produced the entry;
+            # hits stay in the duration histogram so it reflects what callers see
+            execution_time = time.perf_counter() - start_time
+            _process_query_timer.observe(execution_time)
+            return {**cached, "execution_time": execution_time}
 
     try:
-        # Import here to avoid circular imports
-        from .agents.sql_agent import SQLAgent, DatabaseConnectionError, AIServiceError
-        from .graphs.correction_graph import create_correction_graph
-
-        # Initialize SQL agent
-        sql_agent = SQLAgent()
+        sql_agent = _get_sql_agent()
 
         # Process query with memory context
         logger.info(f"Processing query for session {session_id}: {query[:50]}...")
@@ -96,14 +255,14 @@ def process_query_task(self, query: str, session_id: str, history: List[Dict[str
         # Check if SQL generation failed
         if not result.get("sql_query"):
             logger.warning(f"SQL generation failed for query: {query[:50]}")
-            result["execution_time"] = time.time() - start_time
+            result["execution_time"] = time.perf_counter() - start_time
             return result
 
         # Run correction graph if needed
         if result.get("needs_correction", False):
             logger.info(f"Running correction graph for query: {query[:50]}...")
 
-            correction_graph = create_correction_graph()
+            correction_graph = _get_correction_graph()
 
             corrected_result = correction_graph.invoke({
                 "query": query,
@@ -146,31 +305,23 @@ def process_query_task(self, query: str, session_id: str, history: List[Dict[str
                 }
 
         # Add execution time
-        result["execution_time"] = time.time() - start_time
+        result["execution_time"] = time.perf_counter() - start_time
 
-        # Cache the result if caching is enabled
-        # Cache the result if caching is enabled
-        if CACHE["enable_llm_cache"]:
+        # Cache the result if caching is enabled. Failures are not cached, so a
+        # transient DB or LLM error is retried on the next ask. The payload is
+        # encoded here, but the Redis write runs in the background so the task
+        # returns first
+        if CACHE["enable_llm_cache"] and result.get("success"):
             try:
-                # Normalize query by removing whitespace and converting to lowercase
-                normalized_query = " ".join(query.lower().split())
-
-                # Use a simple hash function less prone to variation
-                import hashlib
-                query_hash = hashlib.md5(normalized_query.encode()).hexdigest()
-
-                cache_key = f"query_result:{session_id}:{query_hash}"
-                redis_client = redis.Redis.from_url(REDIS["url"])
-                redis_client.setex(
-                    cache_key,
-                    CACHE["query_cache_ttl"],
-                    json.dumps(result, default=json_serialize)
-                )
-                logger.info(f"Successfully cached query result")
+                payload = orjson.dumps(result, default=json_serialize, option=_ORJSON_OPTIONS)
+                if len(payload) >= _COMPRESS_MIN_BYTES:
+                    payload = _zstd_compressor.compress(payload)
+                _local_results[cache_key] = result
+                _cache_writer.submit(_write_query_cache, cache_key, payload)
             except Exception as e:
                 logger.warning(f"Failed to cache query result: {str(e)}")
         # Record metrics
-        task_duration.labels(task_name="process_query_task").observe(time.time() - start_time)
+        _process_query_timer.observe(time.perf_counter() - start_time)
 
         return result
 
@@ -199,16 +350,14 @@ def process_query_task(self, query: str, session_id: str, history: List[Dict[str
 )
 def generate_suggestions_task(query: str, answer: str, history: List[Dict[str, Any]]) -> List[str]:
     """Generate follow-up suggestions asynchronously with error handling"""
-    start_time = time.time()
+    start_time = time.perf_counter()
 
     try:
-        from .services.suggestion_service import SuggestionService
-
         suggestion_service = SuggestionService()
-        suggestions = suggestion_service.generate_suggestions(query, answer, history)
+        suggestions = _run_async(suggestion_service.generate_suggestions(query, answer, history))
 
         # Record metrics
-        task_duration.labels(task_name="generate_suggestions_task").observe(time.time() - start_time)
+        _suggestions_timer.observe(time.perf_counter() - start_time)
 
         return suggestions
 
@@ -217,32 +366,70 @@ def generate_suggestions_task(query: str, answer: str, history: List[Dict[str, A
         return []
 
 
+@celery_app.task(
+    name="generate_suggestions_preview_task",
+    base=LogErrorsTask,
+    max_retries=2
+)
+def generate_suggestions_preview_task(query: str, history: List[Dict[str, Any]]) -> List[str]:
+    """Generate follow-up suggestions from the query and history alone, before the answer exists"""
+    start_time = time.perf_counter()
+
+    try:
+        suggestion_service = SuggestionService()
+        suggestions = _run_async(suggestion_service.generate_suggestions(query, "", history))
+
+        # Record metrics
+        _suggestions_preview_timer.observe(time.perf_counter() - start_time)
+
+        return suggestions
+
+    except Exception as e:
+        logger.error(f"Error generating preview suggestions: {str(e)}")
+        return []
+
+
+def process_query_with_suggestions(query: str, session_id: str, history: List[Dict[str, Any]]) -> GroupResult:
+    """Run the query and speculative suggestions in parallel.
+
+    The GroupResult resolves to [query_result, suggestions]; callers merge the
+    two, preferring answer-based suggestions when they have time to fetch them.
+    """
+    return group([
+        process_query_task.s(query, session_id, history),
+        generate_suggestions_preview_task.s(query, history),
+    ]).apply_async()
+
+
 @celery_app.task(
     name="cache_schema_task",
-    base=LogErrorsTask
+    base=LogErrorsTask,
+    ignore_result=True
 )
 def cache_schema_task() -> bool:
     """Periodically cache database schema with error handling"""
-    start_time = time.time()
+    start_time = time.perf_counter()
 
     try:
-        # Import here to avoid circular imports
-        from .agents.sql_agent import SQLAgent
-
-        sql_agent = SQLAgent()
+        sql_agent = _get_sql_agent()
         schema_info = sql_agent.get_schema_info()
 
-        redis_client = redis.Redis.from_url(REDIS["url"])
-        redis_client.set(
-            "db_schema",
-            json.dumps(schema_info),
-            ex=CACHE["schema_cache_ttl"]
-        )
+        global _last_schema_hash
+        payload = orjson.dumps(schema_info, default=json_serialize, option=_ORJSON_OPTIONS)
+        schema_hash = xxhash.xxh3_64_intdigest(payload)
+        redis_client = _redis_client()
 
-        logger.info("Successfully cached database schema")
+        # Unchanged schema: refresh the TTL only. EXPIRE is false when the key
+        # is gone (evicted or written by another process), so fall through to SET
+        if schema_hash == _last_schema_hash and redis_client.expire("db_schema", CACHE["schema_cache_ttl"]):
+            logger.info("Database schema unchanged, refreshed cache TTL")
+        else:
+            redis_client.set("db_schema", payload, ex=CACHE["schema_cache_ttl"])
+            _last_schema_hash = schema_hash
+            logger.info("Successfully cached database schema")
 
         # Record metrics
-        task_duration.labels(task_name="cache_schema_task").observe(time.time() - start_time)
+        _cache_schema_timer.observe(time.perf_counter() - start_time)
 
         return True
 
@@ -253,26 +440,25 @@ def cache_schema_task() -> bool:
 
 @celery_app.task(
     name="cleanup_sessions_task",
-    base=LogErrorsTask
+    base=LogErrorsTask,
+    ignore_result=True
 )
 def cleanup_sessions_task() -> Dict[str, Any]:
     """Periodically clean up expired sessions"""
-    start_time = time.time()
+    start_time = time.perf_counter()
 
     try:
-        from .services.memory_service import MemoryService
-
         memory_service = MemoryService()
         memory_service.cleanup_expired_sessions()
 
         # Record metrics
-        task_duration.labels(task_name="cleanup_sessions_task").observe(time.time() - start_time)
+        _cleanup_sessions_timer.observe(time.perf_counter() - start_time)
 
-        return {"status": "success", "timestamp": datetime.utcnow().isoformat()}
+        return {"status": "success", "timestamp": datetime.now(timezone.utc).isoformat(timespec='milliseconds')}
 
     except Exception as e:
         logger.error(f"Error during session cleanup: {str(e)}")
-        return {"status": "error", "error": str(e), "timestamp": datetime.utcnow().isoformat()}
+        return {"status": "error", "error": str(e), "timestamp": datetime.now(timezone.utc).isoformat(timespec='milliseconds')}
 
 
 # Configure periodic tasks
@@ -289,7 +475,10 @@ celery_app.conf.beat_schedule = {
 
 
 # Health check task
-@celery_app.task(name="health_check_task")
+_HEALTH_OK = {"status": "healthy"}
+
+
+@celery_app.task(name="health_check_task", ignore_result=True)
 def health_check_task():
     """Simple health check task"""
-    return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
\ No newline at end of file
+    return {**_HEALTH_OK, "timestamp": datetime.now(timezone.utc).isoformat(timespec='milliseconds')}
\ No newline at end of file